@@ -1,14 +1,31 @@
 import asyncio
+import copy
+import hashlib
+import heapq
+import html
 import json
 import logging
 import os
+import queue
 import re
 import random
+import sqlite3
+import struct
+import threading
+import time
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from contextvars import ContextVar
+from fnmatch import fnmatchcase
 from datetime import datetime, timedelta
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple, Any
+from typing import Dict, List, Optional, Tuple, Any, AsyncIterator, Awaitable, Callable
+from urllib.parse import quote, urlsplit
 
 from typing import Tuple
+import aiohttp
 from aiogram import Bot, Dispatcher, types, Router, F
 from aiogram.filters import Command
 from aiogram.types import (
@@ -17,23 +34,28 @@ from aiogram.types import (
     ReplyKeyboardRemove,
     Message
 )
-from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest, TelegramRetryAfter
+from aiogram.methods import GetUpdates, SendMessage, TelegramMethod
 from aiogram.filters.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from bs4 import BeautifulSoup
 from dotenv import load_dotenv
+from playwright.async_api import BrowserContext, Route, async_playwright, TimeoutError as PlaywrightTimeoutError
 from selenium import webdriver
-from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
 from selenium_stealth import stealth
+from sortedcontainers import SortedList
 from selenium.common.exceptions import (
     TimeoutException,
     WebDriverException,
     NoSuchElementException  # Добавить эту строку
 )
+from yarl import URL
 
-OZON_LINK_RE = re.compile(r'https?://(www.)?ozon.(ru|by)/(product/|t/)[^s]+')
+OZON_LINK_RE = re.compile(r'(?:https?://)?(?:www\.)?ozon\.(?:ru|by)/(?:product/|t/)\S+')
+HTML_TAG_RE = re.compile(r'<(/?)([a-zA-Z]+)[^>]*>')
 
 # =============================================
 # НАСТРОЙКИ И ИНИЦИАЛИЗАЦИЯ
@@ -48,13 +70,73 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 DATA_FILE = Path("user_data.json")
+DB_FILE = Path("user_data.db")
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")  # json | sqlite | journal
+SAVE_INTERVAL = int(os.getenv("SAVE_INTERVAL", 5))  # секунды между фоновыми сохранениями
+SNAPSHOT_INTERVAL = int(os.getenv("SNAPSHOT_INTERVAL", 300))  # секунды между снимками при журнале
+MIGRATION_BATCH = int(os.getenv("MIGRATION_BATCH", 500))  # пользователей за одну порцию миграции
+HISTORY_DIR = Path("price_history")
+# Уровни хранения истории: (имя, шаг агрегации в секундах, сколько хранить)
+HISTORY_TIERS = (
+    ("raw", 0, timedelta(days=14)),
+    ("hourly", 3600, timedelta(days=400)),
+    ("daily", 86400, timedelta(days=5 * 365)),
+)
+SHORT_LINKS_FILE = Path("short_links.json")
 LOG_FILE = Path("user_actions.log")
 MAX_URLS_PER_USER = 10
 REQUEST_TIMEOUT = 20
 ALLOWED_INTERVALS = [0, 1, 3, 5, 10, 24]
 DEFAULT_INTERVAL = 24
 INACTIVE_USER_THRESHOLD_DAYS = 30
+# Режим "По изменению цены": у каждого товара своя частота проверки в этих пределах (минуты)
+ADAPTIVE_MIN_MINUTES = int(os.getenv("ADAPTIVE_MIN_MINUTES", 15))
+ADAPTIVE_MAX_MINUTES = int(os.getenv("ADAPTIVE_MAX_MINUTES", 360))
+ADAPTIVE_START_MINUTES = int(os.getenv("ADAPTIVE_START_MINUTES", 30))  # начальный интервал товара без изменений в истории
+ADAPTIVE_HISTORY_DAYS = 14  # по скольким дням истории цен оценивается начальная частота
+FETCH_BUDGET_PER_HOUR = int(os.getenv("FETCH_BUDGET_PER_HOUR", 600))  # загрузок в час на этот режим
 OZON_DOMAINS = ("ru", "by")
+FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY", 3))
+FETCH_TIMEOUT = int(os.getenv("FETCH_TIMEOUT", 90))  # секунды на загрузку одной страницы
+CHECK_WORKERS = int(os.getenv("CHECK_WORKERS", 4))  # воркеров для проверок пользователей
+CHECK_JOB_TIMEOUT = int(os.getenv("CHECK_JOB_TIMEOUT", 300))  # секунды на проверку одного пользователя
+CHECK_FETCH_TIMEOUT = int(os.getenv("CHECK_FETCH_TIMEOUT", 900))  # секунды на загрузку товаров плановой пачки
+CHECK_RETRY_DELAY = int(os.getenv("CHECK_RETRY_DELAY", 60))  # через сколько повторить прерванную плановую проверку
+TELEGRAM_RATE = float(os.getenv("TELEGRAM_RATE", 25))  # запросов к Telegram в секунду на весь бот (лимит ~30)
+TELEGRAM_CHAT_INTERVAL = float(os.getenv("TELEGRAM_CHAT_INTERVAL", 1.0))  # секунды между уведомлениями в один чат
+TELEGRAM_MAX_RETRIES = 5  # повторов запроса после RetryAfter
+TELEGRAM_MESSAGE_LIMIT = 4096
+MANUAL_PROGRESS_INTERVAL = 1.0  # секунды между правками сообщения о ходе ручной проверки
+# Лимиты параллельных загрузок по доменам, например "ozon.ru:3,ozon.by:1"
+FETCH_DOMAIN_CONCURRENCY = {
+    domain.strip(): int(limit)
+    for domain, limit in (
+        item.split(":") for item in os.getenv("FETCH_DOMAIN_CONCURRENCY", "").split(",") if item.strip()
+    )
+}
+DRIVER_POOL_SIZE = int(os.getenv("DRIVER_POOL_SIZE", FETCH_CONCURRENCY))
+DRIVER_MAX_PAGES = int(os.getenv("DRIVER_MAX_PAGES", 50))
+DRIVER_MAX_RSS_MB = int(os.getenv("DRIVER_MAX_RSS_MB", 1024))
+# Chrome сам прерывает загрузку страницы раньше FETCH_TIMEOUT, и поток Selenium освобождается
+DRIVER_PAGE_LOAD_TIMEOUT = int(os.getenv("DRIVER_PAGE_LOAD_TIMEOUT", FETCH_TIMEOUT // 2))
+PRODUCT_CACHE_TTL = int(os.getenv("PRODUCT_CACHE_TTL", 600))  # секунды
+PRODUCT_CACHE_SIZE = int(os.getenv("PRODUCT_CACHE_SIZE", 2000))
+SKU_KEYS_SIZE = int(os.getenv("SKU_KEYS_SIZE", 20000))  # запомненных соответствий ссылка -> артикул
+CHECK_MAX_STALENESS = int(os.getenv("CHECK_MAX_STALENESS", 0))  # 0 — плановые проверки всегда с сайта
+THROTTLE_START_RATE = float(os.getenv("THROTTLE_START_RATE", 1.0))  # запросов в секунду на домен
+THROTTLE_MIN_RATE = 0.05
+THROTTLE_MAX_RATE = float(os.getenv("THROTTLE_MAX_RATE", 5.0))
+THROTTLE_RATE_STEP = 0.05  # прибавка к скорости за каждый успешный запрос
+THROTTLE_WINDOW = 20  # сколько последних исходов учитывает предохранитель
+BREAKER_FAILURE_RATIO = 0.5
+BREAKER_MIN_SAMPLES = 5
+BREAKER_COOLDOWN = int(os.getenv("BREAKER_COOLDOWN", 120))  # секунды
+BREAKER_MAX_COOLDOWN = 1800
+BREAKER_MAX_WAIT = 30  # дольше ждать паузу не имеет смысла — загрузка сразу считается неудачной
+FETCH_ENGINE = os.getenv("FETCH_ENGINE", "selenium")  # selenium | http | playwright
+SCRAPE_PROFILE = os.getenv("SCRAPE_PROFILE", "light")  # light | full
+SCRAPE_BASELINE_EVERY = int(os.getenv("SCRAPE_BASELINE_EVERY", 10))  # каждый N-й драйвер с профилем full для сравнения
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
 INTERVAL_NAMES = {
     0: "По изменению цены",
     1: "1 час",
@@ -156,164 +238,1046 @@ class ProductMenu:
         buttons.append([KeyboardButton(text="🔙 Назад")])
         return ReplyKeyboardMarkup(keyboard=buttons, resize_keyboard=True)
 
-async def show_animation(msg: Message, text: str):
-    """Показывает анимированное сообщение"""
-    for emoji in ["🔄", "⏳", "🌀"]:
-        await msg.edit_text(f"{emoji} {text}")
-        await asyncio.sleep(0.2)
-    await msg.edit_text(text)
-
-async def delete_messages(chat_id: str, message_ids: list):
-    """Удаляет список сообщений с обработкой ошибок"""
-    for msg_id in message_ids:
-        try:
-            await bot.delete_message(chat_id, msg_id)
-            await asyncio.sleep(0.1)
-        except TelegramBadRequest as e:
-            if "message to delete not found" not in str(e):
-                logger.error(f"Ошибка удаления: {e}")
-        except Exception as e:
-            logger.error(f"Ошибка: {e}")
-
-async def animate_success(msg: Message):
-    """Анимация успешного завершения БЕЗ удаления сообщения"""
-    try:
-        for emoji in ["✨", "🌟", "💫", "🎉"]:
-            try:
-                await msg.edit_text(f"{emoji} {msg.html_text}")
-                await asyncio.sleep(0.3)
-            except TelegramBadRequest as e:
-                if "message to edit not found" in str(e):
-                    return
-    except Exception as e:
-        logger.error(f"Ошибка анимации: {e}")
-
 def truncate(text: str, max_length: int) -> str:
     """Обрезает текст с многоточием"""
     return (text[:max_length] + '...') if len(text) > max_length else text
 
-async def show_main_menu(message: Message):
-    """Показывает главное меню"""
-    await message.answer(
-        "Выберите действие:",
-        reply_markup=ProductMenu.get_main_menu()
-    )
-
-async def update_skus():
-    logger.info("=== Начало обновления артикулов ===")
-    for chat_id in user_data:
-        user_info = user_data[chat_id]
-        urls = user_info.get('urls', [])
-        if not urls:
-            continue
-
-        # Получаем данные сразу по всем товарам списком
-        try:
-            products_data = await batch_fetch_products(urls)
-        except Exception as e:
-            logger.error(f"Ошибка пакетного получения данных: {e}")
-            continue
-
-        updated_skus = {}
-        for url in urls:
-            name, prices, new_full_sku, is_out_of_stock = products_data.get(url, (None, {}, None, True))
-            if new_full_sku:
-                # Удаляем старый артикул
-                for old_sku in list(user_info.get('skus', {})):
-                    if user_info['skus'][old_sku] == url:
-                        del user_info['skus'][old_sku]
-                # Добавляем новый
-                updated_skus[new_full_sku] = url
-
-        # Сохраняем обновленные данные
-        user_info['skus'].update(updated_skus)
-        save_user_data()
-
-    logger.info("=== Обновление артикулов завершено ===")
-
-
 def normalize_ozon_url(url: str) -> str:
     """Приводит ozon-ссылку к каноническому виду (без www и query-параметров)"""
     url = url.lower().split('?')[0].replace('www.', '')
     return url
 
-def is_duplicate(url: str, full_sku: str, user_info: dict) -> Optional[str]:
+def is_duplicate(url: str, full_sku: str, chat_id: str) -> Optional[str]:
     """
     Проверяет наличие дубликата по артикулу (full_sku) и по url.
     Возвращает строку-пояснение для пользователя, если есть дубль, иначе None.
     """
     # Проверка по артикулу (full_sku)
-    if full_sku and 'skus' in user_info and full_sku in user_info['skus']:
-        exist_url = user_info['skus'][full_sku]
+    exist_url = user_data.find_sku(chat_id, full_sku) if full_sku else None
+    if exist_url:
         return f"✔️ Этот товар уже отслеживается:\n{exist_url}"
     # Проверка дубликата по url (для страховки)
-    norm_url = normalize_ozon_url(url)
-    for u in user_info.get('urls', []):
-        if normalize_ozon_url(u) == norm_url:
-            return f"✔️ Такой товар уже добавлен:\n{u}"
+    exist_url = user_data.find_url(chat_id, url)
+    if exist_url:
+        return f"✔️ Такой товар уже добавлен:\n{exist_url}"
     return None
 
+def product_key(url: str, user_info: Optional[dict] = None) -> str:
+    """Ключ товара в каталоге: артикул, если он известен, иначе нормализованный URL"""
+    if user_info:
+        subscription = user_info.get('subscriptions', {}).get(url)
+        if subscription and subscription.get('sku'):
+            return subscription['sku']
+    return normalize_ozon_url(url)
+
+def subscription_names(user_info: dict) -> Dict[str, str]:
+    """Названия товаров пользователя из общего каталога: {url: название}"""
+    names = {}
+    for url in user_info.get('subscriptions', {}):
+        entry = product_catalog.get(product_key(url, user_info))
+        if entry and entry.get('name'):
+            names[url] = entry['name']
+    return names
+
 # =============================================
 # ФУНКЦИИ РАБОТЫ С ДАННЫМИ
 # =============================================
 
-def migrate_user_data(data: dict) -> dict:
-    """Мигрирует данные для поддержки артикулов"""
-    migrated = {}
-    for chat_id, user_info in data.items():
-        migrated[chat_id] = {
-            'urls': user_info.get('urls', []),
-            'previous_prices': user_info.get('previous_prices', {}),
-            'product_names': user_info.get('product_names', {}),
-            'skus': user_info.get('skus', {}),  # Новое поле: {артикул: url}
-            'last_active': user_info.get('last_active', datetime.now().isoformat()),
-            'interval': user_info.get('interval', DEFAULT_INTERVAL),
-            'last_check': user_info.get('last_check', None),
-            'is_tracking': user_info.get('is_tracking', True)
+def normalize_prices(prices: Dict[Any, int]) -> Dict[int, int]:
+    """После JSON ключи цен становятся строками — возвращаем им тип int"""
+    return {int(idx): price for idx, price in prices.items()}
+
+# Шаги миграции записи пользователя: (версия, описание, функция), по возрастанию версии
+MIGRATIONS: List[Tuple[int, str, Callable[[dict, Dict[str, Any]], dict]]] = []
+
+def migration(version: int, description: str):
+    """Регистрирует шаг миграции; шаг получает запись пользователя и каталог и возвращает новую запись"""
+    def register(step):
+        MIGRATIONS.append((version, description, step))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return step
+    return register
+
+@migration(1, "артикулы из ссылок и значения по умолчанию")
+def migrate_add_skus(user_info: dict, catalog: Dict[str, Any]) -> dict:
+    if 'subscriptions' in user_info:
+        return user_info
+    skus = user_info.get('skus')
+    if skus is None:
+        # Попытка извлечь артикул из URL
+        skus = {}
+        for url in user_info.get('urls', []):
+            match = re.search(r'/product/(\d+)/', url)
+            if match:
+                skus[match.group(1)] = url
+    return {
+        'urls': user_info.get('urls', []),
+        'previous_prices': user_info.get('previous_prices', {}),
+        'product_names': user_info.get('product_names', {}),
+        'skus': skus,  # {артикул: url}
+        'last_active': user_info.get('last_active', datetime.now().isoformat()),
+        'interval': user_info.get('interval', DEFAULT_INTERVAL),
+        'last_check': user_info.get('last_check', None),
+        'is_tracking': user_info.get('is_tracking', True)
+    }
+
+@migration(2, "общий каталог товаров вместо копий у каждого пользователя")
+def migrate_to_catalog(user_info: dict, catalog: Dict[str, Any]) -> dict:
+    if 'subscriptions' in user_info:
+        return user_info
+    url_skus = {url: sku for sku, url in user_info['skus'].items()}
+    subscriptions = {}
+    for url in user_info['urls']:
+        sku = url_skus.get(url)
+        prices = normalize_prices(user_info['previous_prices'].get(url, {}))
+        # {'sku': артикул, 'seen': цены из последнего уведомления}
+        subscriptions[url] = {'sku': sku, 'seen': prices}
+        name = user_info['product_names'].get(url)
+        if name:
+            catalog.setdefault(sku or normalize_ozon_url(url), {
+                'url': url,
+                'name': name,
+                'prices': prices,
+                'in_stock': True,
+                'fetched_at': None
+            })
+    return {
+        'subscriptions': subscriptions,
+        'last_active': user_info['last_active'],
+        'interval': user_info['interval'],
+        'last_check': user_info['last_check'],
+        'is_tracking': user_info['is_tracking']
+    }
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def upgrade_record(user_info: dict, catalog: Dict[str, Any], version: int) -> dict:
+    """Прогоняет запись через шаги миграции новее ее версии"""
+    version = user_info.get('schema', version)
+    for step_version, _, step in MIGRATIONS:
+        if step_version > version:
+            user_info = step(user_info, catalog)
+    user_info['schema'] = SCHEMA_VERSION
+    return user_info
+
+def replace_user_url(user_info: dict, old_url: str, new_url: str):
+    """Заменяет ссылку пользователя на другую форму той же ссылки (например, раскрытую короткую)"""
+    subscriptions = user_info['subscriptions']
+    if new_url in subscriptions:
+        subscriptions.pop(old_url)
+    else:
+        # Пересобираем словарь, чтобы ссылка осталась на своем месте в списке
+        user_info['subscriptions'] = {
+            (new_url if url == old_url else url): sub for url, sub in subscriptions.items()
+        }
+
+# Изменения, которые считаются активностью пользователя
+ACTIVITY_MUTATIONS = {"add_url", "remove_url", "clear_urls", "set_interval", "set_tracking", "touch"}
+
+def apply_mutation(data: Dict[str, Any], catalog: Dict[str, Any], record: dict, version: int = SCHEMA_VERSION):
+    """
+    Применяет одно изменение (из обработчика или из журнала) к пользователям или каталогу.
+    version — версия схемы хранилища для записей, еще не прошедших миграцию.
+    """
+    op = record["op"]
+    if op == "product_update":
+        catalog[record["key"]] = {
+            'url': record["url"],
+            'name': record["name"],
+            'prices': normalize_prices(record["prices"]),
+            'in_stock': record["in_stock"],
+            'fetched_at': record["fetched_at"]
         }
-        # Автоматическая миграция для существующих данных
-        if 'skus' not in user_info:
-            migrated[chat_id]['skus'] = {}
-            for url in user_info.get('urls', []):
-                # Попытка извлечь артикул из URL
-                match = re.search(r'/product/(\d+)/', url)
-                if match:
-                    migrated[chat_id]['skus'][match.group(1)] = url
-    return migrated
-
-
-def load_user_data() -> Dict[str, Any]:
-    if DATA_FILE.exists():
+        return
+    if op == "product_drop":
+        catalog.pop(record["key"], None)
+        return
+
+    chat_id = record["chat_id"]
+    if op == "create_user":
+        data[chat_id] = copy.deepcopy(record["user"])
+        return
+    if op == "delete_user":
+        data.pop(chat_id, None)
+        return
+
+    user_info = data.get(chat_id)
+    if user_info is None:
+        return
+    if user_info.get('schema', version) < SCHEMA_VERSION:
+        user_info = data[chat_id] = upgrade_record(user_info, catalog, version)
+    subscriptions = user_info['subscriptions']
+
+    if op == "add_url":
+        subscriptions[record["url"]] = {'sku': record["sku"], 'seen': normalize_prices(record["prices"])}
+    elif op == "remove_url":
+        subscriptions.pop(record["url"], None)
+    elif op == "clear_urls":
+        subscriptions.clear()
+    elif op == "price_update":
+        if record["url"] in subscriptions:
+            subscriptions[record["url"]]['seen'] = normalize_prices(record["prices"])
+    elif op == "set_sku":
+        if record["url"] in subscriptions:
+            subscriptions[record["url"]]['sku'] = record["sku"]
+    elif op == "replace_url":
+        if record["old_url"] in subscriptions:
+            replace_user_url(user_info, record["old_url"], record["new_url"])
+    elif op == "set_interval":
+        user_info['interval'] = record["interval"]
+    elif op == "set_tracking":
+        user_info['is_tracking'] = record["is_tracking"]
+    elif op == "checked":
+        user_info['last_check'] = record["last_check"]
+
+    if op in ACTIVITY_MUTATIONS:
+        user_info['last_active'] = record["at"]
+
+class JsonStorage:
+    """Хранение пользователей и каталога товаров одним JSON-файлом"""
+    flush_interval = SAVE_INTERVAL
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.seq = 0
+        self.version = SCHEMA_VERSION  # версия схемы записей в файле
+
+    def load(self) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        if not self.path.exists():
+            return {}, {}
         try:
-            with open(DATA_FILE, "r", encoding='utf-8') as f:
-                return migrate_user_data(json.load(f))
+            with open(self.path, "r", encoding='utf-8') as f:
+                data = json.load(f)
         except (json.JSONDecodeError, UnicodeDecodeError) as e:
             logger.error(f"Ошибка загрузки данных: {e}")
-    return {}
+            return {}, {}
+        # Старый формат — только словарь пользователей
+        if "users" not in data:
+            self.version = 0
+            return data, {}
+        self.seq = data.get("seq", 0)
+        self.version = data.get("version", 0)
+        users, catalog = data["users"], data.get("catalog", {})
+        # JSON превращает ключи цен в строки — возвращаем им тип int
+        for user_info in users.values():
+            for subscription in user_info.get('subscriptions', {}).values():
+                subscription['seen'] = normalize_prices(subscription['seen'])
+        for entry in catalog.values():
+            entry['prices'] = normalize_prices(entry['prices'])
+        return users, catalog
+
+    def replay(self, data: Dict[str, Any], catalog: Dict[str, Any]):
+        """Журнала нет — проигрывать нечего"""
+
+    def record(self, record: dict):
+        """Отдельные изменения не журналируются — файл пишется целиком"""
+
+    def prepare(self, data: Dict[str, Any], catalog: Dict[str, Any],
+                chat_ids: Optional[List[str]] = None, product_keys: Optional[List[str]] = None) -> str:
+        """Снимок для записи; вызывается в потоке event loop. Файл пишется целиком, списки изменений не важны"""
+        return json.dumps(
+            {"version": self.version, "seq": self.seq, "users": data, "catalog": catalog},
+            ensure_ascii=False, separators=(",", ":")
+        )
+
+    def write(self, payload: str):
+        """Атомарная запись: временный файл + rename, чтобы сбой не оставил файл наполовину"""
+        tmp_path = self.path.with_suffix(".json.tmp")
+        with open(tmp_path, "w", encoding='utf-8') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def save(self, data: Dict[str, Any], catalog: Dict[str, Any]):
+        self.write(self.prepare(data, catalog))
+
+    def close(self):
+        pass
+
+class JournalStorage(JsonStorage):
+    """
+    Снимок user_data.json плюс журнал изменений (по строке JSON на изменение).
+    Строки пишет отдельный поток: все, что накопилось за время прошлого fsync, уходит одной пачкой
+    с одним fsync (групповая запись), так что сбой теряет только еще не записанную пачку.
+    При запуске загружается снимок и проигрывается только хвост журнала;
+    при каждом снимке журнал начинается заново.
+    """
+    flush_interval = SNAPSHOT_INTERVAL
+
+    def __init__(self, path: Path):
+        super().__init__(path)
+        self.journal_path = path.with_suffix(".journal")
+        self.rotated_path = path.with_suffix(".journal.1")
+        self.groups = 0  # пачек записано (fsync)
+        self._journal = None
+        # Строки журнала, а также события ротации (threading.Event) и None для остановки
+        self._queue: "queue.Queue" = queue.Queue()
+        self._rotation = threading.Event()
+        self._writer: Optional[threading.Thread] = None
+
+    def replay(self, data: Dict[str, Any], catalog: Dict[str, Any]):
+        """Проигрывает хвост журнала поверх загруженного снимка и открывает журнал на дозапись"""
+        replayed = 0
+        for path in (self.rotated_path, self.journal_path):
+            replayed += self._replay(path, data, catalog)
+        if replayed:
+            logger.info(f"Журнал: проиграно {replayed} изменений после снимка seq={self.seq - replayed}")
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+        self._writer = threading.Thread(target=self._write_loop, name="journal", daemon=True)
+        self._writer.start()
+
+    def _replay(self, path: Path, data: Dict[str, Any], catalog: Dict[str, Any]) -> int:
+        if not path.exists():
+            return 0
+        replayed = 0
+        valid_bytes = 0
+        with open(path, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except (json.JSONDecodeError, UnicodeDecodeError):
+                    # Недописанная последняя запись после сбоя
+                    logger.warning(f"Журнал {path}: отброшена поврежденная запись")
+                    break
+                valid_bytes += len(line)
+                if record["seq"] <= self.seq:
+                    continue
+                apply_mutation(data, catalog, record, self.version)
+                self.seq = record["seq"]
+                replayed += 1
+        if valid_bytes < path.stat().st_size:
+            with open(path, "r+b") as f:
+                f.truncate(valid_bytes)
+        return replayed
+
+    def record(self, record: dict):
+        """Ставит запись в очередь потока журнала; event loop на диск не ходит"""
+        self.seq += 1
+        self._queue.put(json.dumps({"seq": self.seq, **record}, ensure_ascii=False) + "\n")
+
+    def _write_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            try:
+                while True:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+            lines = []
+            for item in batch:
+                if isinstance(item, str):
+                    lines.append(item)
+                    continue
+                # Ротация и остановка — строго после уже поставленных в очередь строк
+                self._sync(lines)
+                lines = []
+                if item is None:
+                    return
+                try:
+                    self._rotate()
+                except OSError as e:
+                    logger.error(f"Ошибка ротации журнала: {e}")
+                item.set()
+            self._sync(lines)
+
+    def _sync(self, lines: List[str]):
+        if not lines:
+            return
+        try:
+            self._journal.write("".join(lines))
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self.groups += 1
+        except OSError as e:
+            logger.error(f"Ошибка записи журнала: {e}")
+
+    def prepare(self, data: Dict[str, Any], catalog: Dict[str, Any],
+                chat_ids: Optional[List[str]] = None, product_keys: Optional[List[str]] = None) -> str:
+        # Журнал ротируется в момент снимка: все, что после, попадет уже в новый файл.
+        # Саму ротацию делает поток журнала, дописав строки, поставленные до нее
+        self._rotation = threading.Event()
+        self._queue.put(self._rotation)
+        return super().prepare(data, catalog)
+
+    def _rotate(self):
+        self._journal.close()
+        if self.rotated_path.exists():
+            # Прошлый снимок не записался — дописываем журнал к ожидающему
+            with open(self.rotated_path, "a", encoding="utf-8") as rotated, \
+                    open(self.journal_path, "r", encoding="utf-8") as current:
+                rotated.write(current.read())
+            self.journal_path.unlink()
+        else:
+            os.replace(self.journal_path, self.rotated_path)
+        self._journal = open(self.journal_path, "a", encoding="utf-8")
+
+    def write(self, payload: str):
+        # Снимок заменяет ротированную часть журнала — она должна быть дописана до конца
+        self._rotation.wait()
+        super().write(payload)
+        self.rotated_path.unlink(missing_ok=True)
+
+    def close(self):
+        if self._writer:
+            self._queue.put(None)
+            self._writer.join()
+        if self._journal:
+            self._journal.close()
+
+class SqliteStorage:
+    """
+    Хранение в SQLite (WAL): строка на пользователя, подписку и товар каталога.
+    Сохранение пользователя или товара обновляет только его строки.
+    """
+    flush_interval = SAVE_INTERVAL
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        chat_id TEXT PRIMARY KEY,
+        interval INTEGER NOT NULL,
+        last_check TEXT,
+        last_active TEXT NOT NULL,
+        is_tracking INTEGER NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS catalog (
+        key TEXT PRIMARY KEY,
+        url TEXT NOT NULL,
+        name TEXT,
+        card_price INTEGER,
+        regular_price INTEGER,
+        in_stock INTEGER NOT NULL,
+        fetched_at TEXT
+    );
+    CREATE TABLE IF NOT EXISTS subscriptions (
+        chat_id TEXT NOT NULL,
+        url TEXT NOT NULL,
+        position INTEGER NOT NULL,
+        sku TEXT,
+        card_price INTEGER,
+        regular_price INTEGER,
+        PRIMARY KEY (chat_id, url)
+    );
+    """
+
+    def __init__(self, path: Path, import_from: Optional[Path] = None):
+        self.path = path
+        self.import_from = import_from
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        # Записи собираются из таблиц уже в текущей схеме; версия таблиц — в user_version
+        self.version = SCHEMA_VERSION
+        self.conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    @staticmethod
+    def _prices(card_price: Optional[int], regular_price: Optional[int]) -> Dict[int, int]:
+        return {i: p for i, p in ((1, card_price), (2, regular_price)) if p is not None}
+
+    def load(self) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        if self.conn.execute("SELECT 1 FROM users LIMIT 1").fetchone() is None:
+            self._import_json()
+
+        data = {}
+        for chat_id, interval, last_check, last_active, is_tracking in self.conn.execute(
+            "SELECT chat_id, interval, last_check, last_active, is_tracking FROM users"
+        ):
+            data[chat_id] = {
+                'subscriptions': {},
+                'schema': SCHEMA_VERSION,
+                'last_active': last_active,
+                'interval': interval,
+                'last_check': last_check,
+                'is_tracking': bool(is_tracking)
+            }
+
+        for chat_id, url, sku, card_price, regular_price in self.conn.execute(
+            "SELECT chat_id, url, sku, card_price, regular_price FROM subscriptions ORDER BY chat_id, position"
+        ):
+            user_info = data.get(chat_id)
+            if user_info is not None:
+                user_info['subscriptions'][url] = {'sku': sku, 'seen': self._prices(card_price, regular_price)}
+
+        catalog = {}
+        for key, url, name, card_price, regular_price, in_stock, fetched_at in self.conn.execute(
+            "SELECT key, url, name, card_price, regular_price, in_stock, fetched_at FROM catalog"
+        ):
+            catalog[key] = {
+                'url': url,
+                'name': name,
+                'prices': self._prices(card_price, regular_price),
+                'in_stock': bool(in_stock),
+                'fetched_at': fetched_at
+            }
+        return data, catalog
+
+    def replay(self, data: Dict[str, Any], catalog: Dict[str, Any]):
+        """Журнала нет — проигрывать нечего"""
+
+    def record(self, record: dict):
+        """Изменения пишутся построчно при сохранении, журнал не нужен"""
+
+    def _import_json(self):
+        """Однократный импорт из user_data.json в пустую базу"""
+        if not self.import_from or not self.import_from.exists():
+            return
+        source = JsonStorage(self.import_from)
+        data, catalog = source.load()
+        if not data:
+            return
+        data = {chat_id: upgrade_record(user_info, catalog, source.version) for chat_id, user_info in data.items()}
+        self.save(data, catalog)
+        imported_path = self.import_from.with_suffix(".json.imported")
+        os.replace(self.import_from, imported_path)
+        logger.info(f"Импортировано {len(data)} пользователей из {self.import_from} (файл переименован в {imported_path})")
+
+    def prepare(self, data: Dict[str, Any], catalog: Dict[str, Any],
+                chat_ids: Optional[List[str]] = None, product_keys: Optional[List[str]] = None
+                ) -> Tuple[bool, Dict[str, Optional[dict]], Dict[str, Optional[dict]]]:
+        """Копии измененных пользователей и товаров (None — удалены); вызывается в потоке event loop"""
+        if chat_ids is None:
+            return True, copy.deepcopy(data), copy.deepcopy(catalog)
+        return (
+            False,
+            {chat_id: copy.deepcopy(data.get(chat_id)) for chat_id in chat_ids},
+            {key: copy.deepcopy(catalog.get(key)) for key in product_keys or []},
+        )
+
+    def write(self, payload: Tuple[bool, Dict[str, Optional[dict]], Dict[str, Optional[dict]]]):
+        full, users, products = payload
+        with self.conn:
+            if full:
+                # Полное сохранение: удаляем пропавших пользователей и товары
+                for (chat_id,) in self.conn.execute("SELECT chat_id FROM users").fetchall():
+                    users.setdefault(chat_id, None)
+                for (key,) in self.conn.execute("SELECT key FROM catalog").fetchall():
+                    products.setdefault(key, None)
+            for chat_id, user_info in users.items():
+                if user_info is not None:
+                    self._write_user(chat_id, user_info)
+                else:
+                    self._delete_user(chat_id)
+            for key, entry in products.items():
+                if entry is not None:
+                    self._write_product(key, entry)
+                else:
+                    self.conn.execute("DELETE FROM catalog WHERE key = ?", (key,))
+
+    def save(self, data: Dict[str, Any], catalog: Dict[str, Any]):
+        self.write(self.prepare(data, catalog))
+
+    def _write_user(self, chat_id: str, user_info: dict):
+        self.conn.execute(
+            "INSERT INTO users (chat_id, interval, last_check, last_active, is_tracking) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(chat_id) DO UPDATE SET interval = excluded.interval, last_check = excluded.last_check, "
+            "last_active = excluded.last_active, is_tracking = excluded.is_tracking",
+            (
+                chat_id,
+                user_info.get('interval', DEFAULT_INTERVAL),
+                user_info.get('last_check'),
+                user_info.get('last_active', datetime.now().isoformat()),
+                int(user_info.get('is_tracking', True)),
+            )
+        )
+
+        subscriptions = user_info.get('subscriptions', {})
+        self.conn.executemany(
+            "INSERT INTO subscriptions (chat_id, url, position, sku, card_price, regular_price) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(chat_id, url) DO UPDATE SET position = excluded.position, sku = excluded.sku, "
+            "card_price = excluded.card_price, regular_price = excluded.regular_price",
+            [
+                (chat_id, url, position, sub.get('sku'), sub['seen'].get(1), sub['seen'].get(2))
+                for position, (url, sub) in enumerate(subscriptions.items())
+            ]
+        )
+        self.conn.execute(
+            "DELETE FROM subscriptions WHERE chat_id = ? AND url NOT IN (SELECT value FROM json_each(?))",
+            (chat_id, json.dumps(list(subscriptions)))
+        )
+
+    def _write_product(self, key: str, entry: dict):
+        self.conn.execute(
+            "INSERT INTO catalog (key, url, name, card_price, regular_price, in_stock, fetched_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET url = excluded.url, name = excluded.name, "
+            "card_price = excluded.card_price, regular_price = excluded.regular_price, "
+            "in_stock = excluded.in_stock, fetched_at = excluded.fetched_at",
+            (
+                key,
+                entry['url'],
+                entry.get('name'),
+                entry['prices'].get(1),
+                entry['prices'].get(2),
+                int(entry.get('in_stock', True)),
+                entry.get('fetched_at'),
+            )
+        )
+
+    def _delete_user(self, chat_id: str):
+        for table in ("users", "subscriptions"):
+            self.conn.execute(f"DELETE FROM {table} WHERE chat_id = ?", (chat_id,))
+
+    def close(self):
+        self.conn.close()
+
+class PriceHistory:
+    """
+    Append-only история цен: на товар по файлу на уровень хранения,
+    записи фиксированной длины (время, цена по карте, обычная цена, наличие) — 13 байт.
+    Старые точки сворачиваются в почасовые и посуточные минимумы.
+    Новые записи копятся в памяти и дописываются в файлы пачкой; диск трогают только потоки.
+    """
+    RECORD = struct.Struct("<IIIB")
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self._lock = threading.Lock()  # файлы: дозапись и сворачивание
+        self._pending: Dict[str, List[bytes]] = {}  # ключ товара -> записи, еще не попавшие в файл
+        self._flushing: Dict[str, List[bytes]] = {}
+
+    def _path(self, key: str, tier: str) -> Path:
+        name = key if re.fullmatch(r"[\w-]+", key) else hashlib.sha1(key.encode()).hexdigest()
+        return self.directory / f"{name}.{tier}"
+
+    def append(self, key: str, prices: Dict[int, int], in_stock: bool, timestamp: Optional[float] = None):
+        record = self.RECORD.pack(
+            int(timestamp or time.time()),
+            prices.get(1) or 0,
+            prices.get(2) or prices.get(1) or 0,
+            int(in_stock),
+        )
+        self._pending.setdefault(key, []).append(record)
+
+    def _write_pending(self, pending: Dict[str, List[bytes]]):
+        """Дописывает записи в файлы; записанные ключи убираются из pending"""
+        with self._lock:
+            self.directory.mkdir(exist_ok=True)
+            for key in list(pending):
+                with open(self._path(key, "raw"), "ab") as f:
+                    f.write(b"".join(pending[key]))
+                del pending[key]
+
+    async def flush(self):
+        if not self._pending:
+            return
+        self._flushing, self._pending = self._pending, {}
+        try:
+            await asyncio.to_thread(self._write_pending, self._flushing)
+        except OSError as e:
+            logger.error(f"Ошибка записи истории цен: {e}")
+            # Недописанное вернется в следующую пачку, перед более новыми записями
+            for key, records in self._flushing.items():
+                self._pending[key] = records + self._pending.get(key, [])
+        finally:
+            self._flushing = {}
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(SAVE_INTERVAL)
+            await self.flush()
+
+    def _buffered(self, key: str, since: int, until: int) -> List[Tuple[int, int, int, bool]]:
+        records = list(self._flushing.get(key, ())) + list(self._pending.get(key, ()))
+        points = []
+        for record in records:
+            ts, card, regular, in_stock = self.RECORD.unpack(record)
+            if since <= ts <= until:
+                points.append((ts, card, regular, bool(in_stock)))
+        return points
+
+    def _read(self, key: str, tier: str, since: int, until: int) -> List[Tuple[int, int, int, bool]]:
+        try:
+            buf = self._path(key, tier).read_bytes()
+        except FileNotFoundError:
+            return []
+        size = self.RECORD.size
+        count = len(buf) // size
+
+        # Бинарный поиск первой записи с временем >= since
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.RECORD.unpack_from(buf, mid * size)[0] < since:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        points = []
+        for i in range(lo, count):
+            ts, card, regular, in_stock = self.RECORD.unpack_from(buf, i * size)
+            if ts > until:
+                break
+            points.append((ts, card, regular, bool(in_stock)))
+        return points
+
+    def query(self, key: str, since: datetime, until: Optional[datetime] = None) -> List[Tuple[int, int, int, bool]]:
+        """
+        Точки за период по возрастанию времени, от грубых уровней к подробным, включая еще не записанные.
+        Читает файлы — из event loop вызывать через asyncio.to_thread.
+        """
+        since_ts = int(since.timestamp())
+        until_ts = int((until or datetime.now()).timestamp())
+        points = []
+        for tier, _, _ in reversed(HISTORY_TIERS):
+            points.extend(self._read(key, tier, since_ts, until_ts))
+        points.extend(self._buffered(key, since_ts, until_ts))
+        return points
+
+    async def lowest(self, key: str, days: int = 30) -> Optional[int]:
+        """Минимальная цена по карте за последние days дней"""
+        points = await asyncio.to_thread(self.query, key, datetime.now() - timedelta(days=days))
+        prices = [card for _, card, _, _ in points if card]
+        return min(prices) if prices else None
+
+    def compact(self):
+        """Сворачивает устаревшие точки в следующий уровень и удаляет вышедшие за хранение"""
+        if not self.directory.exists():
+            return
+        now = int(time.time())
+        suffixes = {f".{tier}" for tier, _, _ in HISTORY_TIERS}
+        keys = {path.stem for path in self.directory.iterdir() if path.suffix in suffixes}
+        for key in keys:
+            with self._lock:
+                for (tier, _, keep), (next_tier, step, _) in zip(HISTORY_TIERS, HISTORY_TIERS[1:]):
+                    # Граница выравнивается по шагу следующего уровня, чтобы не резать корзины
+                    cutoff = (now - int(keep.total_seconds())) // step * step
+                    old_points = self._read(key, tier, 0, cutoff - 1)
+                    if not old_points:
+                        continue
+                    buckets: Dict[int, List[int]] = {}
+                    for ts, card, regular, in_stock in old_points:
+                        bucket = buckets.setdefault(ts // step * step, [0, 0, 0])
+                        bucket[0] = min(filter(None, (bucket[0], card)), default=0)
+                        bucket[1] = min(filter(None, (bucket[1], regular)), default=0)
+                        bucket[2] |= int(in_stock)
+                    with open(self._path(key, next_tier), "ab") as f:
+                        for ts in sorted(buckets):
+                            f.write(self.RECORD.pack(ts, *buckets[ts]))
+                    self._rewrite(key, tier, skip=len(old_points))
+
+                last_tier, _, keep = HISTORY_TIERS[-1]
+                expired = self._read(key, last_tier, 0, now - int(keep.total_seconds()) - 1)
+                if expired:
+                    self._rewrite(key, last_tier, skip=len(expired))
+
+    def _rewrite(self, key: str, tier: str, skip: int):
+        """Отбрасывает первые skip записей файла уровня (атомарно)"""
+        path = self._path(key, tier)
+        rest = path.read_bytes()[skip * self.RECORD.size:]
+        tmp_path = path.with_suffix(f".{tier}.tmp")
+        tmp_path.write_bytes(rest)
+        os.replace(tmp_path, path)
+
+price_history = PriceHistory(HISTORY_DIR)
+
+def create_storage():
+    if STORAGE_BACKEND == "sqlite":
+        return SqliteStorage(DB_FILE, import_from=DATA_FILE)
+    if STORAGE_BACKEND == "json":
+        return JsonStorage(DATA_FILE)
+    if STORAGE_BACKEND == "journal":
+        return JournalStorage(DATA_FILE)
+    raise ValueError(f"Неизвестный STORAGE_BACKEND: {STORAGE_BACKEND}")
+
+class StoreFlusher:
+    """Копит изменения и сохраняет их пачкой в фоне не чаще раза в SAVE_INTERVAL секунд"""
+    def __init__(self, storage):
+        self.storage = storage
+        self.dirty: set = set()
+        self.dirty_products: set = set()
+        self.everything = False
+        self.writes = 0
+        self._lock = asyncio.Lock()
+
+    def mark(self, chat_id: Optional[str] = None):
+        if chat_id is None:
+            self.everything = True
+        else:
+            self.dirty.add(chat_id)
+
+    def mark_product(self, key: str):
+        self.dirty_products.add(key)
+
+    async def flush(self):
+        async with self._lock:
+            if not self.everything and not self.dirty and not self.dirty_products:
+                return
+            chat_ids = None if self.everything else list(self.dirty)
+            product_keys = None if self.everything else list(self.dirty_products)
+            self.dirty.clear()
+            self.dirty_products.clear()
+            self.everything = False
+
+            # Снимок делается в потоке event loop, запись — в отдельном потоке
+            payload = self.storage.prepare(user_data.users, product_catalog, chat_ids, product_keys)
+            try:
+                await asyncio.to_thread(self.storage.write, payload)
+                self.writes += 1
+            except (IOError, sqlite3.Error) as e:
+                logger.error(f"Ошибка сохранения данных: {e}")
+                if chat_ids is None:
+                    self.everything = True
+                else:
+                    self.dirty.update(chat_ids)
+                    self.dirty_products.update(product_keys)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.storage.flush_interval)
+            await self.flush()
+            await short_links.flush()
+
+class UserStore(Mapping):
+    """
+    Пользователи (только чтение как dict) и вторичные индексы, которые пересчитываются
+    для пользователя при каждом его изменении:
+    ссылка по нормализованной ссылке и по артикулу, подписчики товара и ссылки,
+    отслеживающие пользователи по интервалу и порядок по последней активности.
+    """
+    def __init__(self, users: Dict[str, Any], catalog: Dict[str, Any]):
+        self.users = users
+        self.catalog = catalog
+        self._by_url: Dict[Tuple[str, str], str] = {}  # (chat_id, нормализованная ссылка) -> ссылка
+        self._by_sku: Dict[Tuple[str, str], str] = {}  # (chat_id, артикул) -> ссылка
+        self._subscribers: Dict[str, set] = {}  # ключ товара -> chat_id подписчиков
+        self._url_subscribers: Dict[str, set] = {}  # нормализованная ссылка -> chat_id подписчиков
+        self._by_interval: Dict[int, set] = {}  # интервал -> chat_id отслеживающих
+        self._by_activity = SortedList()  # (last_active, chat_id)
+        self._indexed: Dict[str, tuple] = {}  # что проиндексировано для пользователя — чтобы убрать
+        for chat_id in users:
+            self._index(chat_id)
+
+    def __getitem__(self, chat_id: str) -> dict:
+        return self.users[chat_id]
+
+    def __iter__(self):
+        return iter(self.users)
+
+    def __len__(self) -> int:
+        return len(self.users)
+
+    def _index(self, chat_id: str):
+        user_info = self.users.get(chat_id)
+        if user_info is None:
+            return
+        urls, skus, keys = [], [], []
+        for url, subscription in user_info.get('subscriptions', {}).items():
+            urls.append((chat_id, normalize_ozon_url(url)))
+            self._by_url[urls[-1]] = url
+            self._url_subscribers.setdefault(urls[-1][1], set()).add(chat_id)
+            if subscription.get('sku'):
+                skus.append((chat_id, subscription['sku']))
+                self._by_sku[skus[-1]] = url
+            keys.append(product_key(url, user_info))
+            self._subscribers.setdefault(keys[-1], set()).add(chat_id)
+
+        interval = user_info.get('interval', DEFAULT_INTERVAL) if user_info.get('is_tracking', True) else None
+        if interval is not None:
+            self._by_interval.setdefault(interval, set()).add(chat_id)
+        activity = (user_info.get('last_active') or "", chat_id)
+        self._by_activity.add(activity)
+        self._indexed[chat_id] = (urls, skus, keys, interval, activity)
+
+    def _unindex(self, chat_id: str):
+        indexed = self._indexed.pop(chat_id, None)
+        if indexed is None:
+            return
+        urls, skus, keys, interval, activity = indexed
+        for key in urls:
+            self._by_url.pop(key, None)
+            subscribers = self._url_subscribers.get(key[1])
+            if subscribers is not None:
+                subscribers.discard(chat_id)
+                if not subscribers:
+                    del self._url_subscribers[key[1]]
+        for key in skus:
+            self._by_sku.pop(key, None)
+        for key in keys:
+            subscribers = self._subscribers.get(key)
+            if subscribers is not None:
+                subscribers.discard(chat_id)
+                if not subscribers:
+                    del self._subscribers[key]
+        if interval is not None:
+            self._by_interval[interval].discard(chat_id)
+        self._by_activity.discard(activity)
+
+    def apply(self, record: dict, version: int):
+        """Применяет изменение и обновляет индексы затронутого пользователя"""
+        chat_id = record.get("chat_id")
+        if chat_id is None:
+            # Изменение каталога индексы пользователей не затрагивает
+            apply_mutation(self.users, self.catalog, record, version)
+            return
+        self._unindex(chat_id)
+        apply_mutation(self.users, self.catalog, record, version)
+        self._index(chat_id)
+
+    def replace(self, chat_id: str, user_info: dict):
+        self._unindex(chat_id)
+        self.users[chat_id] = user_info
+        self._index(chat_id)
+
+    def find_url(self, chat_id: str, url: str) -> Optional[str]:
+        """Сохраненная ссылка пользователя, совпадающая с url после нормализации"""
+        return self._by_url.get((chat_id, normalize_ozon_url(url)))
+
+    def find_sku(self, chat_id: str, sku: str) -> Optional[str]:
+        return self._by_sku.get((chat_id, sku))
+
+    def subscribers(self, key: str) -> set:
+        return self._subscribers.get(key, set())
+
+    def url_subscribers(self, url: str) -> set:
+        """Пользователи с подпиской на url (после нормализации), с артикулом или без"""
+        return self._url_subscribers.get(normalize_ozon_url(url), set())
+
+    def intervals(self) -> List[int]:
+        return [interval for interval, chat_ids in self._by_interval.items() if chat_ids]
+
+    def with_interval(self, interval: int) -> List[str]:
+        """Отслеживающие пользователи с данным интервалом"""
+        return list(self._by_interval.get(interval, ()))
+
+    def inactive_since(self, threshold: datetime) -> List[str]:
+        """Пользователи, последняя активность которых раньше threshold"""
+        bound = (threshold.isoformat(), "")
+        return [chat_id for _, chat_id in self._by_activity.irange(maximum=bound, inclusive=(True, False))]
+
+def load_user_data() -> Tuple[UserStore, Dict[str, Any]]:
+    """Пользователи и общий каталог товаров: снимок, затем хвост журнала. Миграции — отдельно, в фоне"""
+    data, catalog = storage.load()
+    storage.replay(data, catalog)
+    return UserStore(data, catalog), catalog
+
+def upgrade_user(chat_id: str) -> bool:
+    """Доводит запись пользователя до текущей схемы, если она еще не мигрирована"""
+    user_info = user_data.get(chat_id)
+    if user_info is None or user_info.get('schema', storage.version) >= SCHEMA_VERSION:
+        return False
+    user_data.replace(chat_id, upgrade_record(user_info, product_catalog, storage.version))
+    save_user_data(chat_id)
+    return True
+
+async def run_migrations():
+    """
+    Мигрирует записи порциями по MIGRATION_BATCH, сохраняя результат после каждой порции.
+    Записи помнят свою версию, поэтому прерванная миграция продолжается с того же места.
+    """
+    if storage.version >= SCHEMA_VERSION:
+        return
+    pending = [version for version, _, _ in MIGRATIONS if version > storage.version]
+    logger.info(f"Миграция схемы {storage.version} → {SCHEMA_VERSION}: шаги {pending}, пользователей {len(user_data)}")
+    chat_ids = list(user_data)
+    migrated = 0
+    for start in range(0, len(chat_ids), MIGRATION_BATCH):
+        migrated += sum(upgrade_user(chat_id) for chat_id in chat_ids[start:start + MIGRATION_BATCH])
+        await store_flusher.flush()
+        await asyncio.sleep(0)
+    storage.version = SCHEMA_VERSION
+    save_user_data()
+    await store_flusher.flush()
+    logger.info(f"Миграция схемы завершена: обновлено {migrated} пользователей")
 
-def save_user_data():
+def save_user_data(chat_id: Optional[str] = None):
+    """Помечает данные пользователя (или всех, если chat_id не указан) для фонового сохранения"""
+    store_flusher.mark(chat_id)
+
+def commit_mutation(record: dict):
+    user_data.apply(record, storage.version)
     try:
-        with open(DATA_FILE, "w", encoding='utf-8') as f:
-            json.dump(user_data, f, indent=2, ensure_ascii=False)
-    except IOError as e:
-        logger.error(f"Ошибка сохранения данных: {e}")
+        storage.record(record)
+    except OSError as e:
+        logger.error(f"Ошибка записи журнала: {e}")
+
+# Изменения, после которых срок следующей проверки пользователя (или его товаров) пересчитывается
+SCHEDULE_MUTATIONS = {"create_user", "delete_user", "set_interval", "set_tracking", "add_url", "replace_url", "set_sku"}
+
+def mutate(op: str, chat_id: str, **fields):
+    """Единственная точка изменения user_data: применяет изменение, журналирует и помечает к сохранению"""
+    commit_mutation({"op": op, "chat_id": chat_id, "at": datetime.now().isoformat(), **fields})
+    save_user_data(chat_id)
+    if op in SCHEDULE_MUTATIONS:
+        schedule_user(chat_id)
+    if op == "delete_user" or (op == "set_tracking" and not fields["is_tracking"]):
+        check_pool.cancel(chat_id)
+
+def mutate_product(op: str, key: str, **fields):
+    """То же для общего каталога товаров"""
+    commit_mutation({"op": op, "key": key, **fields})
+    store_flusher.mark_product(key)
+
+def update_catalog(url: str, product: Tuple[Optional[str], Dict[int, int], Optional[str], bool]):
+    """Результат загрузки записывается в каталог один раз — для всех подписчиков товара"""
+    name, prices, full_sku, is_out_of_stock = product
+    if not name:
+        return
+    key = full_sku or normalize_ozon_url(url)
+    fetched_at = datetime.now().isoformat()
+    entry = product_catalog.get(key)
+    if entry and entry['name'] == name and entry['prices'] == prices and entry['in_stock'] == (not is_out_of_stock):
+        # Изменилось только время загрузки — в журнал не пишем, попадет в следующий снимок
+        entry['fetched_at'] = fetched_at
+        store_flusher.mark_product(key)
+        return
+    mutate_product("product_update", key, url=url, name=name, prices=prices,
+                   in_stock=not is_out_of_stock, fetched_at=fetched_at)
 
-user_data = load_user_data()
+storage = create_storage()
+store_flusher = StoreFlusher(storage)
+user_data, product_catalog = load_user_data()
 
 # =============================================
 # WEBDRIVER И РАБОТА С OZON
 # =============================================
 
-def setup_driver() -> webdriver.Chrome:
+class CaptchaDetected(Exception):
+    """Ozon показал капчу вместо страницы товара"""
+
+class CircuitOpen(Exception):
+    """Загрузки с домена приостановлены предохранителем"""
+
+# Профили загрузки страниц: нам нужен только текст трех виджетов
+SCRAPE_PROFILES = {
+    "full": {
+        "page_load_strategy": "normal",
+        "window_size": "1920,1080",
+        "images": True,
+        "blocked_urls": [],
+    },
+    "light": {
+        "page_load_strategy": "eager",
+        "window_size": "800,600",
+        "images": False,
+        # Картинки, шрифты, видео, аналитика и реклама
+        "blocked_urls": [
+            "*.jpg", "*.jpeg", "*.png", "*.gif", "*.webp", "*.avif", "*.svg", "*.ico",
+            "*.woff", "*.woff2", "*.ttf", "*.otf",
+            "*.mp4", "*.webm", "*.m3u8",
+            "*mc.yandex.ru*", "*an.yandex.ru*", "*google-analytics.com*", "*googletagmanager.com*",
+            "*doubleclick.net*", "*top-fwz1.mail.ru*", "*vk.com/rtrg*", "*tracker-api.ozon*",
+        ],
+    },
+}
+
+def setup_driver(profile: str = SCRAPE_PROFILE) -> webdriver.Chrome:
+    settings = SCRAPE_PROFILES[profile]
     options = webdriver.ChromeOptions()
     options.add_argument("--headless=new")
     options.add_argument("--no-sandbox")
     options.add_argument("--disable-dev-shm-usage")
     options.add_argument("--log-level=3")
     options.add_argument("--disable-blink-features=AutomationControlled")
-    options.add_argument("user-agent=Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36")
+    options.add_argument(f"user-agent={USER_AGENT}")
+    options.add_argument(f"--window-size={settings['window_size']}")
+    options.page_load_strategy = settings["page_load_strategy"]
+    if not settings["images"]:
+        options.add_argument("--blink-settings=imagesEnabled=false")
+        options.add_experimental_option("prefs", {"profile.managed_default_content_settings.images": 2})
 
     driver = webdriver.Chrome(options=options)
+    driver.set_page_load_timeout(DRIVER_PAGE_LOAD_TIMEOUT)
+    driver.set_script_timeout(DRIVER_PAGE_LOAD_TIMEOUT)
     stealth(
         driver,
         languages=["en-US", "en"],
@@ -323,87 +1287,1025 @@ def setup_driver() -> webdriver.Chrome:
         renderer="Intel Iris OpenGL Engine",
         fix_hairline=True,
     )
+    if settings["blocked_urls"]:
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": settings["blocked_urls"]})
     return driver
 
+def process_tree_rss_mb(pid: int) -> Optional[float]:
+    """Суммарный RSS процесса и всех его потомков в МБ (Linux, через /proc)"""
+    proc = Path("/proc")
+    if not proc.is_dir():
+        return None
+
+    children: Dict[int, List[int]] = {}
+    for stat_file in proc.glob("[0-9]*/stat"):
+        try:
+            fields = stat_file.read_text().rsplit(")", 1)[1].split()
+            children.setdefault(int(fields[1]), []).append(int(stat_file.parent.name))
+        except (OSError, ValueError, IndexError):
+            continue
+
+    pages = 0
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        try:
+            pages += int((proc / str(current) / "statm").read_text().split()[1])
+        except (OSError, ValueError, IndexError):
+            pass
+        stack.extend(children.get(current, []))
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+
+class DriverLease:
+    """Драйвер из пула и счетчики его использования"""
+    def __init__(self, driver: webdriver.Chrome, profile: str):
+        self.driver = driver
+        self.profile = profile
+        self.pages = 0
+        self.broken = False
+
+    @property
+    def exhausted(self) -> bool:
+        return self.broken or self.pages >= DRIVER_MAX_PAGES
+
+class DriverPool:
+    """Ограниченный пул заранее запущенных драйверов Chrome"""
+    def __init__(self, size: int):
+        self.size = size
+        self._idle: "queue.LifoQueue[DriverLease]" = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+        self._closed = False
+        self.created = 0
+        self.recycled = 0
+
+    def _create(self) -> DriverLease:
+        self.created += 1
+        profile = SCRAPE_PROFILE
+        # Редкие драйверы с полной загрузкой дают базу для оценки экономии профиля
+        if SCRAPE_BASELINE_EVERY and profile != "full" and self.created % SCRAPE_BASELINE_EVERY == 0:
+            profile = "full"
+        return DriverLease(setup_driver(profile), profile)
+
+    def _is_alive(self, lease: DriverLease) -> bool:
+        try:
+            lease.driver.current_url
+            return True
+        except Exception:
+            return False
+
+    def _over_memory(self, lease: DriverLease) -> bool:
+        try:
+            rss = process_tree_rss_mb(lease.driver.service.process.pid)
+        except Exception:
+            return False
+        return rss is not None and rss > DRIVER_MAX_RSS_MB
+
+    def _discard(self, lease: DriverLease):
+        self.recycled += 1
+        try:
+            lease.driver.quit()
+        except Exception:
+            pass
+
+    def warm_up(self):
+        """Запускает драйверы до размера пула, чтобы первая проверка не ждала Chrome"""
+        while not self._closed and self.created - self.recycled < self.size:
+            try:
+                self._idle.put(self._create())
+            except Exception as e:
+                logger.error(f"Ошибка запуска драйвера: {e}")
+                break
+
+    @contextmanager
+    def lease(self):
+        """Выдает драйвер из пула и возвращает его обратно (или пересоздает)"""
+        self._slots.acquire()
+        try:
+            lease = None
+            while lease is None:
+                try:
+                    lease = self._idle.get_nowait()
+                except queue.Empty:
+                    lease = self._create()
+                    break
+                if not self._is_alive(lease):
+                    self._discard(lease)
+                    lease = None
+
+            try:
+                yield lease
+            finally:
+                if self._closed or lease.exhausted or self._over_memory(lease):
+                    reason = "сбой" if lease.broken else f"{lease.pages} стр."
+                    logger.info(f"Пересоздание драйвера ({reason})")
+                    self._discard(lease)
+                else:
+                    self._idle.put(lease)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+driver_pool = DriverPool(DRIVER_POOL_SIZE)
+# Свои потоки по числу драйверов: зависший Chrome занимает поток этого пула, а не общего
+# executor, через который идут сохранение данных и история цен
+selenium_executor = ThreadPoolExecutor(max_workers=DRIVER_POOL_SIZE, thread_name_prefix="selenium")
+
 def clean_price(price_text: str) -> Optional[int]:
     try:
         return int(re.sub(r"[^\d]", "", price_text))
     except (ValueError, TypeError, AttributeError):
         return None
 
-async def batch_fetch_products(urls: List[str]) -> Dict[str, Tuple[Optional[str], Dict[int, int], Optional[str], bool]]:
-    """Обрабатывает все URL за одну сессию драйвера"""
-    result = {}
+class FetchMetrics:
+    """Объем и время загрузки страниц в разрезе профилей (потокобезопасно)"""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals: Dict[str, List[float]] = {}  # профиль -> [страниц, байт, мс]
+
+    def record(self, profile: str, nbytes: int, ms: float):
+        with self._lock:
+            totals = self._totals.setdefault(profile, [0, 0, 0.0])
+            totals[0] += 1
+            totals[1] += nbytes
+            totals[2] += ms
+
+    def average(self, profile: str) -> Optional[Tuple[float, float]]:
+        with self._lock:
+            totals = self._totals.get(profile)
+            if not totals or not totals[0]:
+                return None
+            return totals[1] / totals[0], totals[2] / totals[0]
+
+    def report(self) -> List[str]:
+        # Снимок под замком: record вызывается из потоков драйверов
+        with self._lock:
+            totals = {profile: list(values) for profile, values in self._totals.items() if values[0]}
+        lines = []
+        full = totals.get("full")
+        baseline = (full[1] / full[0], full[2] / full[0]) if full else None
+        for profile in sorted(totals):
+            pages, nbytes, ms = totals[profile]
+            nbytes, ms = nbytes / pages, ms / pages
+            line = f"• Профиль {profile}: {pages} стр., {nbytes / 1024:.0f} КБ, {ms:.0f} мс на страницу"
+            if baseline and profile != "full":
+                line += f" (экономия {(baseline[0] - nbytes) / 1024:.0f} КБ, {baseline[1] - ms:.0f} мс)"
+            lines.append(line)
+        return lines
+
+fetch_metrics = FetchMetrics()
+
+class ProductCache:
+    """LRU-кэш результатов загрузки товаров с ограниченным временем жизни"""
+    def __init__(self, ttl: int, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries: "OrderedDict[str, Tuple[float, tuple]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str, max_age: Optional[float] = None) -> Optional[tuple]:
+        """Возвращает данные товара, если они не старше max_age (и TTL)"""
+        entry = self._entries.get(key)
+        if entry:
+            age = time.monotonic() - entry[0]
+            if age > self.ttl:
+                del self._entries[key]
+            elif max_age is None or age <= max_age:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+        self.misses += 1
+        return None
 
-    def sync_fetch():
-        driver = setup_driver()
+    def put(self, url: str, data: tuple):
+        """Сохраняет данные под нормализованным URL"""
+        key = normalize_ozon_url(url)
+        self._entries[key] = (time.monotonic(), data)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def stats(self) -> str:
+        total = self.hits + self.misses
+        rate = f"{self.hits / total:.0%}" if total else "н/д"
+        return f"попаданий {self.hits}, промахов {self.misses} ({rate}), записей {len(self._entries)}/{self.max_size}"
+
+product_cache = ProductCache(PRODUCT_CACHE_TTL, PRODUCT_CACHE_SIZE)
+
+PRODUCT_WIDGETS = ("webProductHeading", "webPrice", "webDetailSKU", "webOutOfStock")
+
+def parse_widget_states(states: Dict[str, Any]) -> Tuple[Optional[str], Dict[int, int], Optional[str], bool]:
+    """Разбирает состояния виджетов Ozon ({"webPrice-123-default-1": "{...}", ...})"""
+    name, prices, full_sku, is_out_of_stock = None, {}, None, False
+    for key, raw_state in states.items():
+        widget = key.split("-", 1)[0]
+        if widget not in PRODUCT_WIDGETS:
+            continue
+        try:
+            state = json.loads(raw_state) if isinstance(raw_state, str) else raw_state
+        except json.JSONDecodeError:
+            continue
+        if not isinstance(state, dict):
+            continue
+
+        if widget == "webProductHeading":
+            name = state.get("title") or name
+        elif widget == "webPrice":
+            if state.get("isAvailable") is False:
+                is_out_of_stock = True
+            found = [p for p in (clean_price(state.get("cardPrice")), clean_price(state.get("price"))) if p is not None]
+            for i, price in enumerate(found[:2], 1):
+                prices[i] = price
+        elif widget == "webDetailSKU":
+            full_sku = str(state.get("sku") or "") or full_sku
+        elif widget == "webOutOfStock":
+            is_out_of_stock = True
+    return name, prices, full_sku, is_out_of_stock
+
+def parse_product_html(html: str) -> Tuple[Optional[str], Dict[int, int], Optional[str], bool]:
+    """Достает название, цены, артикул и наличие из HTML страницы товара"""
+    soup = BeautifulSoup(html, "html.parser")
+
+    # Серверный рендер Ozon кладет состояния виджетов в <div id="state-..." data-state="...">
+    states = {
+        div["id"][len("state-"):]: div["data-state"]
+        for div in soup.select('div[id^="state-"][data-state]')
+    }
+    name, prices, full_sku, is_out_of_stock = parse_widget_states(states)
+
+    # Если состояний нет — разметка самих виджетов
+    if not name:
+        heading = soup.select_one('[data-widget="webProductHeading"] h1')
+        name = heading.get_text(strip=True) if heading else None
+
+    if not prices:
+        price_spans = [
+            span for span in soup.select('[data-widget="webPrice"] span')
+            if any("₽" in text for text in span.find_all(string=True, recursive=False))
+        ]
+        for i, span in enumerate(price_spans[:2], 1):
+            price = clean_price(span.get_text())
+            if price is not None:
+                prices[i] = price
+
+    if not full_sku:
+        sku_elem = soup.select_one('[data-widget="webDetailSKU"]')
+        match = re.search(r'Артикул:\s*(\S+)', sku_elem.get_text(" ", strip=True)) if sku_elem else None
+        full_sku = match.group(1) if match else None
+
+    if soup.find(string=re.compile("Этот товар закончился")):
+        is_out_of_stock = True
+
+    return name or None, prices, full_sku, is_out_of_stock
+
+def is_complete_product(data: Tuple[Optional[str], Dict[int, int], Optional[str], bool]) -> bool:
+    name, prices, full_sku, is_out_of_stock = data
+    return bool(name) and bool(prices or is_out_of_stock)
+
+# Переданные байты страницы по Resource Timing API
+PAGE_BYTES_SCRIPT = """
+const entries = performance.getEntriesByType('navigation').concat(performance.getEntriesByType('resource'));
+return entries.reduce((total, entry) => total + (entry.transferSize || 0), 0);
+"""
+
+# Одно условие готовности: капча, закончившийся товар или отрисованные цена и заголовок
+PAGE_READY_SCRIPT = """
+return location.href.includes('captcha')
+    || !!(document.body && document.body.textContent.includes('Этот товар закончился'))
+    || !!(document.querySelector('[data-widget="webPrice"]')
+          && document.querySelector('[data-widget="webProductHeading"] h1'));
+"""
+
+def fetch_page(lease: DriverLease, url: str) -> Tuple[Optional[str], Dict[int, int], Optional[str], bool]:
+    """Загружает одну страницу товара в выданном драйвере и разбирает ее снимок"""
+    driver = lease.driver
+    lease.pages += 1
+    try:
+        started = time.monotonic()
+        driver.get(url)
         try:
-            for url in urls:
+            WebDriverWait(driver, 15).until(lambda d: d.execute_script(PAGE_READY_SCRIPT))
+        except TimeoutException:
+            logger.warning(f"Страница {url} не дождалась готовности, разбираем что есть")
+        fetch_metrics.record(
+            lease.profile,
+            driver.execute_script(PAGE_BYTES_SCRIPT) or 0,
+            (time.monotonic() - started) * 1000,
+        )
+
+        if driver.current_url != url and "captcha" in driver.current_url:
+            raise CaptchaDetected(driver.current_url)
+        short_links.remember(url, driver.current_url)
+
+        # Все поля разбираются офлайн из одного снимка страницы
+        return parse_product_html(driver.page_source)
+
+    except CaptchaDetected:
+        raise
+    except Exception as e:
+        # Остальные ошибки WebDriver (кроме таймаутов) означают упавший Chrome
+        if isinstance(e, WebDriverException) and not isinstance(e, TimeoutException):
+            lease.broken = True
+        logger.error(f"Ошибка обработки {url}: {str(e)}")
+        return None, {}, None, True
+
+async def fetch_one_selenium(url: str) -> Tuple[Optional[str], Dict[int, int], Optional[str], bool]:
+    """Загружает один товар на драйвере из общего пула"""
+    def sync_fetch():
+        with driver_pool.lease() as lease:
+            return fetch_page(lease, url)
+
+    # Отмененная по FETCH_TIMEOUT загрузка, еще не взявшая поток, не запустится вовсе
+    return await asyncio.get_running_loop().run_in_executor(selenium_executor, sync_fetch)
+
+# =============================================
+# HTTP-ЗАГРУЗКА БЕЗ БРАУЗЕРА
+# =============================================
+
+COMPOSER_API_PATH = "/api/entrypoint-api.bx/page/json/v2"
+http_session: Optional[aiohttp.ClientSession] = None
+
+def is_captcha_response(url: str, status: int, text: str) -> bool:
+    return status in (403, 429) or "captcha" in url.lower() or "captcha" in text[:5000].lower()
+
+async def get_http_session() -> aiohttp.ClientSession:
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = aiohttp.ClientSession(
+            headers={"User-Agent": USER_AGENT, "Accept-Language": "ru-RU,ru;q=0.9"},
+            timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT),
+        )
+    return http_session
+
+async def fetch_product_http(url: str) -> Optional[Tuple[Optional[str], Dict[int, int], Optional[str], bool]]:
+    """
+    Загружает товар через page-composer JSON, а затем через HTML страницы.
+    Возвращает None, если страницу не удалось разобрать; при капче (и 403/429) — CaptchaDetected.
+    """
+    session = await get_http_session()
+    parts = urlsplit(url)
+    started = time.monotonic()
+    nbytes = 0
+
+    try:
+        composer_url = f"{parts.scheme}://{parts.netloc}{COMPOSER_API_PATH}?url={quote(parts.path)}"
+        async with session.get(composer_url) as resp:
+            text = await resp.text()
+            nbytes += len(await resp.read())
+            if is_captcha_response(str(resp.url), resp.status, text):
+                raise CaptchaDetected(f"HTTP {resp.status}: {resp.url}")
+            if resp.status == 200:
                 try:
-                    driver.get(url)
-                    WebDriverWait(driver, 15).until(
-                        lambda d: d.current_url.startswith("https://www.ozon.") or
-                                  d.current_url.startswith("https://ozon.")
-                    )
-
-                    # Кончился ли товар
-                    is_out_of_stock = False
-                    try:
-                        WebDriverWait(driver, 5).until(
-                            EC.presence_of_element_located((By.XPATH, '//*[contains(text(), "Этот товар закончился")]'))
-                        )
-                        is_out_of_stock = True
-                    except Exception:
-                        pass
-
-                    # Получаем артикул
-                    full_sku = None
-                    try:
-                        sku_elem = driver.find_element(By.XPATH, '//*[@data-widget="webDetailSKU"]')
-                        match = re.search(r'Артикул:\s*(\S+)', sku_elem.text.strip())
-                        full_sku = match.group(1) if match else None
-                    except Exception:
-                        pass
-
-                    # Цены
-                    prices = {}
-                    try:
-                        price_elems = WebDriverWait(driver, 10).until(
-                            EC.presence_of_all_elements_located((By.XPATH, '//*[@data-widget="webPrice"]//span[contains(text(),"₽")]'))
-                        )
-                        for i, elem in enumerate(price_elems[:2], 1):
-                            price = clean_price(elem.text)
-                            if price is not None:
-                                prices[i] = price
-                    except Exception:
-                        pass
-
-                    # Название
-                    name = None
-                    try:
-                        heading_elem = WebDriverWait(driver, 7).until(
-                            EC.visibility_of_element_located((By.XPATH, '//*[@data-widget="webProductHeading"]//h1'))
-                        )
-                        name = heading_elem.text.strip()
-                    except Exception:
-                        pass
-
-                    result[url] = (name, prices, full_sku, is_out_of_stock)
-                    if driver.current_url != url and "captcha" in driver.current_url:
-                        raise Exception("Обнаружена капча")
+                    data = parse_widget_states(json.loads(text).get("widgetStates", {}))
+                    if is_complete_product(data):
+                        fetch_metrics.record("http", nbytes, (time.monotonic() - started) * 1000)
+                        return data
+                except (json.JSONDecodeError, AttributeError):
+                    pass
+
+        async with session.get(url) as resp:
+            text = await resp.text()
+            nbytes += len(await resp.read())
+            short_links.remember(url, str(resp.url))
+            if is_captcha_response(str(resp.url), resp.status, text):
+                raise CaptchaDetected(f"HTTP {resp.status}: {resp.url}")
+            if resp.status == 200:
+                data = parse_product_html(text)
+                if is_complete_product(data):
+                    fetch_metrics.record("http", nbytes, (time.monotonic() - started) * 1000)
+                    return data
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.warning(f"HTTP: ошибка загрузки {url}: {e}")
+        return None
+
+    logger.warning(f"HTTP: не удалось разобрать {url}")
+    return None
+
+async def fetch_one_http(url: str) -> Tuple[Optional[str], Dict[int, int], Optional[str], bool]:
+    """
+    Загружает товар без браузера, отдавая в Selenium только ошибки разбора.
+    Капча не обходится браузером: она доходит до предохранителя домена в fetch_limited.
+    """
+    data = await fetch_product_http(url)
+    if data is None:
+        logger.info(f"HTTP: {url} передан в Selenium")
+        data = await fetch_one_selenium(url)
+    return data
+
+async def close_http_session():
+    if http_session and not http_session.closed:
+        await http_session.close()
+
+# =============================================
+# КОРОТКИЕ ССЫЛКИ ozon.ru/t/
+# =============================================
+
+def is_short_link(url: str) -> bool:
+    return urlsplit(url).path.startswith("/t/")
+
+def canonical_product_url(url: str) -> Optional[str]:
+    """Ссылка на товар без параметров или None, если это не страница товара"""
+    parts = urlsplit(url)
+    if not parts.path.startswith("/product/"):
+        return None
+    return f"{parts.scheme or 'https'}://{parts.netloc.lower()}{parts.path}"
+
+class ShortLinkCache:
+    """
+    Постоянный кэш раскрытых коротких ссылок: короткая ссылка -> ссылка на товар.
+    Новые ссылки попадают в файл пачкой при фоновом сохранении (flush), а не по одной.
+    """
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._links: Dict[str, str] = {}
+        self.dirty = False
+        if path.exists():
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self._links = json.load(f)
+            except (json.JSONDecodeError, UnicodeDecodeError) as e:
+                logger.error(f"Ошибка загрузки коротких ссылок: {e}")
+
+    @staticmethod
+    def _key(url: str) -> str:
+        # Регистр кода короткой ссылки значим, поэтому normalize_ozon_url не подходит
+        parts = urlsplit(url)
+        return f"{parts.netloc.lower().removeprefix('www.')}{parts.path}"
+
+    def get(self, url: str) -> Optional[str]:
+        return self._links.get(self._key(url))
+
+    def remember(self, short_url: str, final_url: str):
+        """Запоминает, куда привела короткая ссылка (вызывается и из потоков драйверов)"""
+        if not is_short_link(short_url):
+            return
+        canonical = canonical_product_url(final_url)
+        if not canonical or self.get(short_url) == canonical:
+            return
+        with self._lock:
+            self._links[self._key(short_url)] = canonical
+            self.dirty = True
+
+    def _write(self, links: Dict[str, str]):
+        tmp_path = self.path.with_suffix(".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(links, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+    async def flush(self):
+        """Сохраняет накопленные ссылки в отдельном потоке"""
+        with self._lock:
+            if not self.dirty:
+                return
+            links = dict(self._links)
+            self.dirty = False
+        try:
+            await asyncio.to_thread(self._write, links)
+        except IOError as e:
+            logger.error(f"Ошибка сохранения коротких ссылок: {e}")
+            self.dirty = True
+
+    def __len__(self):
+        return len(self._links)
 
+short_links = ShortLinkCache(SHORT_LINKS_FILE)
+
+async def resolve_short_link(url: str) -> str:
+    """
+    Раскрывает короткую ссылку в каноническую ссылку на товар по цепочке редиректов.
+    Если раскрыть не удалось, возвращает ссылку как есть.
+    """
+    if not is_short_link(url):
+        return canonical_product_url(url) or url
+    cached = short_links.get(url)
+    if cached:
+        return cached
+
+    session = await get_http_session()
+    current = url
+    try:
+        for _ in range(5):
+            async with session.get(current, allow_redirects=False) as resp:
+                location = resp.headers.get("Location")
+                if resp.status not in (301, 302, 303, 307, 308) or not location:
+                    break
+                current = str(resp.url.join(URL(location)))
+                if canonical_product_url(current):
+                    short_links.remember(url, current)
+                    return short_links.get(url)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.warning(f"Не удалось раскрыть короткую ссылку {url}: {e}")
+    return url
+
+# =============================================
+# PLAYWRIGHT
+# =============================================
+
+PLAYWRIGHT_BLOCKED_TYPES = {"image", "font", "media"}
+
+class PlaywrightBrowser:
+    """
+    Один общий браузер Chromium на процесс, запускается при первой загрузке.
+    Контекст браузера (куки, кэш) общий, пока его держит хоть один пакет или загрузка,
+    и закрывается вместе с последним: у каждой волны проверок свой изолированный контекст.
+    """
+    def __init__(self):
+        self._playwright = None
+        self._browser = None
+        self._lock = asyncio.Lock()
+        self._context: Optional[BrowserContext] = None
+        self._context_lock = asyncio.Lock()
+        self._leases = 0
+
+    async def new_context(self) -> BrowserContext:
+        async with self._lock:
+            if self._browser is None or not self._browser.is_connected():
+                if self._playwright is None:
+                    self._playwright = await async_playwright().start()
+                self._browser = await self._playwright.chromium.launch(
+                    headless=True,
+                    args=["--no-sandbox", "--disable-dev-shm-usage", "--disable-blink-features=AutomationControlled"],
+                )
+
+        width, height = SCRAPE_PROFILES[SCRAPE_PROFILE]["window_size"].split(",")
+        context = await self._browser.new_context(
+            user_agent=USER_AGENT,
+            locale="ru-RU",
+            viewport={"width": int(width), "height": int(height)},
+        )
+        if SCRAPE_PROFILE != "full":
+            await context.route("**/*", block_heavy_resources)
+        return context
+
+    @asynccontextmanager
+    async def lease(self) -> AsyncIterator[BrowserContext]:
+        """Общий контекст браузера на время блока; последний вышедший его закрывает"""
+        self._leases += 1
+        try:
+            async with self._context_lock:
+                if self._context is None:
+                    self._context = await self.new_context()
+                context = self._context
+            yield context
+        finally:
+            self._leases -= 1
+            if not self._leases and self._context is not None:
+                context, self._context = self._context, None
+                await context.close()
+
+    async def close(self):
+        self._context = None  # закрывается вместе с браузером
+        if self._browser:
+            await self._browser.close()
+        if self._playwright:
+            await self._playwright.stop()
+        self._browser = self._playwright = None
+
+playwright_browser = PlaywrightBrowser()
+
+async def block_heavy_resources(route: Route):
+    """Отбрасывает картинки, шрифты, медиа и запросы из списка блокировки профиля"""
+    request = route.request
+    blocked_urls = SCRAPE_PROFILES[SCRAPE_PROFILE]["blocked_urls"]
+    if request.resource_type in PLAYWRIGHT_BLOCKED_TYPES or any(fnmatchcase(request.url, p) for p in blocked_urls):
+        await route.abort()
+    else:
+        await route.continue_()
+
+async def fetch_one_playwright(url: str) -> Tuple[Optional[str], Dict[int, int], Optional[str], bool]:
+    """Загружает один товар во вкладке общего контекста браузера"""
+    async with playwright_browser.lease() as context:
+        return await fetch_page_playwright(context, url)
+
+async def fetch_page_playwright(context: BrowserContext, url: str
+                                ) -> Tuple[Optional[str], Dict[int, int], Optional[str], bool]:
+    page = await context.new_page()
+    try:
+        started = time.monotonic()
+        wait_until = "load" if SCRAPE_PROFILE == "full" else "domcontentloaded"
+        await page.goto(url, wait_until=wait_until, timeout=REQUEST_TIMEOUT * 1000)
+        try:
+            await page.wait_for_function(f"() => {{ {PAGE_READY_SCRIPT} }}", timeout=15000)
+        except PlaywrightTimeoutError:
+            logger.warning(f"Страница {url} не дождалась готовности, разбираем что есть")
+        nbytes = await page.evaluate(f"() => {{ {PAGE_BYTES_SCRIPT} }}")
+        fetch_metrics.record("playwright", nbytes or 0, (time.monotonic() - started) * 1000)
+
+        if "captcha" in page.url:
+            raise CaptchaDetected(page.url)
+        short_links.remember(url, page.url)
+        return parse_product_html(await page.content())
+    except CaptchaDetected:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка обработки {url}: {str(e)}")
+        return None, {}, None, True
+    finally:
+        await page.close()
+
+# =============================================
+# ОБЩАЯ ТОЧКА ЗАГРУЗКИ ТОВАРОВ
+# =============================================
+
+FETCH_ENGINES = {
+    "selenium": fetch_one_selenium,
+    "http": fetch_one_http,
+    "playwright": fetch_one_playwright,
+}
+
+# Общие ресурсы движка на время одного пакета: контекст живет, пока идет пакет,
+# а сами загрузки держат его и после (общая загрузка может пережить начавший ее пакет)
+FETCH_ENGINE_BATCHES = {
+    "playwright": playwright_browser.lease,
+}
+
+class DomainThrottle:
+    """
+    Адаптивный token bucket и предохранитель для одного домена.
+    Скорость растет на успехах и падает на капче и ошибках (AIMD);
+    при высокой доле неудач загрузки ставятся на паузу, затем идут одиночные пробы.
+    """
+    def __init__(self, domain: str):
+        self.domain = domain
+        self.rate = THROTTLE_START_RATE
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.outcomes: "deque[bool]" = deque(maxlen=THROTTLE_WINDOW)
+        self.state = "closed"  # closed | open | half_open
+        self.open_until = 0.0
+        self.cooldown = BREAKER_COOLDOWN
+        self.probing = False
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> bool:
+        """Ждет окончания паузы и свободный токен; True, если это пробный запрос после паузы"""
+        while True:
+            async with self._lock:
+                now = time.monotonic()
+                if self.state == "open" and now >= self.open_until:
+                    self.state = "half_open"
+                    logger.info(f"[{self.domain}] Пауза окончена, пробный запрос")
+
+                if self.state == "open":
+                    wait = self.open_until - now
+                    if wait > BREAKER_MAX_WAIT:
+                        raise CircuitOpen(f"{self.domain}: пауза еще {wait:.0f} с")
+                elif self.state == "half_open" and self.probing:
+                    wait = 1.0
+                else:
+                    self.tokens = min(1.0, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        self.probing = self.state == "half_open"
+                        return self.probing
+                    wait = (1 - self.tokens) / self.rate
+            await asyncio.sleep(wait)
+
+    def record(self, outcome: str):
+        """Учитывает исход запроса: ok, captcha или error"""
+        if outcome == "ok":
+            self.rate = min(THROTTLE_MAX_RATE, self.rate + THROTTLE_RATE_STEP)
+        else:
+            self.rate = max(THROTTLE_MIN_RATE, self.rate * (0.5 if outcome == "captcha" else 0.8))
+
+        if self.state == "half_open":
+            self.probing = False
+            if outcome == "ok":
+                logger.info(f"[{self.domain}] Пробный запрос успешен, загрузки возобновлены")
+                self.state = "closed"
+                self.cooldown = BREAKER_COOLDOWN
+                self.outcomes.clear()
+            else:
+                self.cooldown = min(self.cooldown * 2, BREAKER_MAX_COOLDOWN)
+                self._trip()
+            return
+        if self.state == "open":
+            return
+
+        self.outcomes.append(outcome == "ok")
+        failures = self.outcomes.count(False)
+        if len(self.outcomes) >= BREAKER_MIN_SAMPLES and failures / len(self.outcomes) >= BREAKER_FAILURE_RATIO:
+            self._trip()
+
+    def _trip(self):
+        self.state = "open"
+        self.open_until = time.monotonic() + self.cooldown
+        self.outcomes.clear()
+        logger.warning(f"[{self.domain}] Много капчи/ошибок — пауза {self.cooldown} с, скорость {self.rate:.2f} зап/с")
+
+    def stats(self) -> str:
+        return f"{self.domain}: {self.rate:.2f} зап/с, предохранитель {self.state}"
+
+fetch_slots = asyncio.Semaphore(FETCH_CONCURRENCY)
+domain_slots: Dict[str, asyncio.Semaphore] = {}
+domain_throttles: Dict[str, DomainThrottle] = {}
+
+def url_domain(url: str) -> str:
+    return (urlsplit(url).hostname or "").removeprefix("www.")
+
+async def fetch_limited(url: str) -> Tuple[Optional[str], Dict[int, int], Optional[str], bool]:
+    """Загружает товар с учетом общего лимита параллельности и лимита домена"""
+    domain = url_domain(url)
+    if domain not in domain_slots:
+        domain_slots[domain] = asyncio.Semaphore(FETCH_DOMAIN_CONCURRENCY.get(domain, FETCH_CONCURRENCY))
+        domain_throttles[domain] = DomainThrottle(domain)
+    throttle = domain_throttles[domain]
+
+    # Сначала слот домена: иначе общий слот простаивал бы в ожидании занятого домена
+    async with domain_slots[domain]:
+        try:
+            probe = await throttle.acquire()
+        except CircuitOpen as e:
+            logger.warning(f"Загрузка {url} пропущена: {e}")
+            return None, {}, None, True
+
+        try:
+            async with fetch_slots:
+                try:
+                    # Зависшая страница не держит слот дольше FETCH_TIMEOUT; число сессий браузера
+                    # ограничено пулом драйверов и его потоками, даже если поток Selenium еще дорабатывает
+                    data = await asyncio.wait_for(FETCH_ENGINES[FETCH_ENGINE](url), FETCH_TIMEOUT)
+                except asyncio.TimeoutError:
+                    logger.error(f"Загрузка {url} прервана: дольше {FETCH_TIMEOUT} с")
+                    throttle.record("error")
+                    return None, {}, None, True
+                except CaptchaDetected:
+                    logger.error(f"Ошибка обработки {url}: обнаружена капча")
+                    throttle.record("captcha")
+                    return None, {}, None, True
                 except Exception as e:
-                    logger.error(f"Ошибка обработки {url}: {str(e)}")
-                    result[url] = (None, {}, None, True)
-                    continue
+                    logger.error(f"Ошибка загрузки {url}: {e}")
+                    throttle.record("error")
+                    return None, {}, None, True
+
+            throttle.record("ok" if is_complete_product(data) else "error")
+            return data
+        finally:
+            if probe:
+                # Отмененная проба (например, в ожидании слота) не должна оставить домен на паузе навсегда
+                throttle.probing = False
+
+def record_fetch(url: str, data: Tuple[Optional[str], Dict[int, int], Optional[str], bool]):
+    """Учитывает результат загрузки: кэш, общий каталог и история цен"""
+    name, prices, full_sku, is_out_of_stock = data
+    if is_complete_product(data):
+        # Неполный разбор не кэшируем: иначе добавление товара получало бы его до конца TTL
+        product_cache.put(url, data)
+    update_catalog(url, data)
+    if full_sku:
+        adopt_sku(url, full_sku)
+    if prices or (full_sku and is_out_of_stock):
+        price_history.append(full_sku or normalize_ozon_url(url), prices, not is_out_of_stock)
+
+def adopt_sku(url: str, full_sku: str):
+    """
+    Подписки на url без артикула (старые ссылки вида /product/name-12345/) или со сменившимся
+    артикулом переводятся на загруженный: каталог пишется под артикулом, и подписка должна читать его.
+    """
+    for chat_id in list(user_data.url_subscribers(url)):
+        subscription_url = user_data.find_url(chat_id, url)
+        subscription = user_data[chat_id]['subscriptions'].get(subscription_url)
+        if subscription is not None and subscription.get('sku') != full_sku:
+            mutate("set_sku", chat_id, sku=full_sku, url=subscription_url)
+
+class SingleFlight:
+    """
+    Реестр загрузок в процессе: одновременные запросы одного товара ждут одну общую задачу.
+    Ключ — артикул, если товар уже загружался по этой ссылке, иначе нормализованная ссылка.
+    Общая задача не отменяется вместе с одним из ожидающих и доводит результат до кэша и каталога.
+    """
+    def __init__(self):
+        self.tasks: Dict[str, asyncio.Task] = {}
+        self.skus: "OrderedDict[str, str]" = OrderedDict()  # LRU не больше SKU_KEYS_SIZE
+        for key, entry in product_catalog.items():
+            if entry.get('url'):
+                self._remember(entry['url'], key)
+        self.started = 0
+        self.joined = 0
+
+    def _remember(self, url: str, sku: str):
+        normalized = normalize_ozon_url(url)
+        self.skus[normalized] = sku
+        self.skus.move_to_end(normalized)
+        while len(self.skus) > SKU_KEYS_SIZE:
+            self.skus.popitem(last=False)
+
+    def key(self, url: str) -> str:
+        normalized = normalize_ozon_url(url)
+        return self.skus.get(normalized, normalized)
+
+    def fetch(self, url: str) -> asyncio.Task:
+        key = self.key(url)
+        task = self.tasks.get(key)
+        if task is None:
+            self.started += 1
+            task = asyncio.create_task(self._run(url, key))
+            self.tasks[key] = task
+        else:
+            self.joined += 1
+        return task
+
+    async def _run(self, url: str, key: str) -> Tuple[Optional[str], Dict[int, int], Optional[str], bool]:
+        try:
+            data = await fetch_limited(url)
+            record_fetch(url, data)
+            if data[2]:
+                self._remember(url, data[2])
+            return data
         finally:
+            self.tasks.pop(key, None)
+
+    def stats(self) -> str:
+        return f"загрузок {self.started}, присоединились к идущим {self.joined}, сейчас {len(self.tasks)}"
+
+single_flight = SingleFlight()
+
+async def fetch_tagged(url: str) -> Tuple[str, Tuple[Optional[str], Dict[int, int], Optional[str], bool]]:
+    return url, await asyncio.shield(single_flight.fetch(url))
+
+async def iter_fetch_products(urls: List[str], max_age: Optional[float] = None
+                              ) -> AsyncIterator[Tuple[str, Tuple[Optional[str], Dict[int, int], Optional[str], bool]]]:
+    """
+    Загружает товары выбранным движком (FETCH_ENGINE) и отдает (url, данные) по мере готовности.
+    Если задан max_age, свежие (не старше max_age секунд) данные берутся из кэша и отдаются сразу.
+    """
+    pending = []
+    for url in dict.fromkeys(urls):
+        cached = product_cache.get(normalize_ozon_url(url), max_age) if max_age is not None else None
+        if cached:
+            yield url, cached
+        else:
+            pending.append(url)
+    if not pending:
+        return
+
+    # Страницы грузятся параллельно; медленная задерживает только свой результат.
+    # Товар, который уже грузится для другого запроса, не загружается повторно
+    done = set()
+    try:
+        async with FETCH_ENGINE_BATCHES.get(FETCH_ENGINE, nullcontext)():
+            tasks = [asyncio.create_task(fetch_tagged(url)) for url in pending]
             try:
-                driver.quit()
-            except:
-                pass
-        return result
+                for next_done in asyncio.as_completed(tasks):
+                    url, data = await next_done
+                    done.add(url)
+                    yield url, data
+            finally:
+                for task in tasks:
+                    task.cancel()
+    except Exception as e:
+        logger.error(f"Ошибка пакетной загрузки товаров ({FETCH_ENGINE}): {e}")
+    for url in pending:
+        if url not in done:
+            yield url, (None, {}, None, True)
+
+async def batch_fetch_products(urls: List[str], max_age: Optional[float] = None) -> Dict[str, Tuple[Optional[str], Dict[int, int], Optional[str], bool]]:
+    """Загружает товары пакетом и возвращает все результаты разом (см. iter_fetch_products)"""
+    return {url: data async for url, data in iter_fetch_products(urls, max_age)}
+
+# =============================================
+# ОТПРАВКА СООБЩЕНИЙ
+# =============================================
+
+# Приоритет исходящих запросов: ответы на действия пользователя раньше плановых уведомлений
+PRIORITY_INTERACTIVE, PRIORITY_ALERT = 0, 1
+outbox_priority: ContextVar[int] = ContextVar("outbox_priority", default=PRIORITY_INTERACTIVE)
+
+class Outbox(BaseRequestMiddleware):
+    """
+    Все запросы к Telegram идут через общий token bucket (TELEGRAM_RATE в секунду),
+    свободный токен получает запрос с наивысшим приоритетом; после RetryAfter запрос повторяется.
+    Плановые уведомления ставятся в очередь чата и отправляются не чаще раза в TELEGRAM_CHAT_INTERVAL,
+    проверка не ждет их доставки.
+    """
+    def __init__(self, rate: float, chat_interval: float):
+        self.rate = rate
+        self.chat_interval = chat_interval
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.last_sent: Dict[Any, float] = {}  # chat_id -> время последнего запроса в чат
+        self.pending: Dict[str, deque] = {}  # chat_id -> уведомления в очереди
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.waits = deque(maxlen=200)
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = 0
+        self._granter: Optional[asyncio.Task] = None
+        self._senders: Dict[str, asyncio.Task] = {}
+
+    async def _acquire(self, priority: int):
+        self._seq += 1
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, self._seq, future))
+        if self._granter is None or self._granter.done():
+            self._granter = asyncio.create_task(self._grant())
+        await future
+
+    async def _grant(self):
+        """Раздает токены ожидающим по приоритету, пока очередь не опустеет"""
+        while self._waiters:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(1.0, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():  # ожидавший мог быть отменен
+                self.tokens -= 1
+                future.set_result(None)
+
+    async def __call__(self, make_request, bot: Bot, method: TelegramMethod):
+        if isinstance(method, GetUpdates):
+            # Длинный опрос обновлений не отправляет сообщений
+            return await make_request(bot, method)
+        chat_id = getattr(method, "chat_id", None)
+        chat_id = None if chat_id is None else str(chat_id)
+        for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+            started = time.monotonic()
+            await self._acquire(outbox_priority.get())
+            self.waits.append(time.monotonic() - started)
+            try:
+                response = await make_request(bot, method)
+                self.sent += 1
+                return response
+            except TelegramRetryAfter as e:
+                if attempt == TELEGRAM_MAX_RETRIES:
+                    raise
+                self.retried += 1
+                logger.warning(f"Telegram просит подождать {e.retry_after} с ({type(method).__name__})")
+                # Превышен лимит — притормаживаем все запросы, а не только этот
+                self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+            finally:
+                if chat_id is not None:
+                    self.last_sent[chat_id] = time.monotonic()
+
+    def send_message(self, chat_id: str, text: str, **kwargs):
+        """Ставит уведомление в очередь чата и сразу возвращает управление"""
+        self.pending.setdefault(chat_id, deque()).append(SendMessage(chat_id=chat_id, text=text, **kwargs))
+        if chat_id not in self._senders:
+            self._senders[chat_id] = asyncio.create_task(self._drain(chat_id))
+
+    async def _drain(self, chat_id: str):
+        outbox_priority.set(PRIORITY_ALERT)
+        queue = self.pending[chat_id]
+        try:
+            while queue:
+                wait = self.last_sent.get(chat_id, 0) + self.chat_interval - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                try:
+                    await bot(queue.popleft())
+                except TelegramForbiddenError:
+                    # Пользователь заблокировал бота — остальные уведомления ему не нужны
+                    queue.clear()
+                    if chat_id in user_data:
+                        mutate("delete_user", chat_id)
+                except Exception as e:
+                    self.failed += 1
+                    logger.error(f"Ошибка отправки в {chat_id}: {e}")
+        finally:
+            del self.pending[chat_id]
+            del self._senders[chat_id]
+            self._forget_idle_chats()
+
+    def _forget_idle_chats(self):
+        if len(self.last_sent) > 10000:
+            threshold = time.monotonic() - self.chat_interval
+            self.last_sent = {chat: ts for chat, ts in self.last_sent.items() if ts > threshold}
+
+    async def close(self, timeout: float = 10):
+        """Дает доотправить очередь уведомлений перед остановкой"""
+        if self._senders:
+            await asyncio.wait(list(self._senders.values()), timeout=timeout)
+        for task in list(self._senders.values()):
+            task.cancel()
+
+    def stats(self) -> str:
+        avg_wait = sum(self.waits) / len(self.waits) if self.waits else 0
+        queued = sum(len(queue) for queue in self.pending.values())
+        return (
+            f"отправлено {self.sent}, в очереди {queued} ({len(self.pending)} чатов), "
+            f"ожидание {avg_wait:.2f} с, повторов {self.retried}, ошибок {self.failed}"
+        )
 
-    return await asyncio.to_thread(sync_fetch)
+outbox = Outbox(TELEGRAM_RATE, TELEGRAM_CHAT_INTERVAL)
+bot.session.middleware(outbox)
 
 # =============================================
 # ОБРАБОТКА ЦЕН И УВЕДОМЛЕНИЙ
@@ -416,9 +2318,11 @@ def get_price_display(prices: Dict[int, int]) -> str:
 
 def generate_product_list(user_info: dict) -> str:
     response = ["📋 <b>Отслеживаемые товары:</b>"]
-    for i, url in enumerate(user_info['urls'], 1):
-        product_name = user_info['product_names'].get(url)
-        prices = user_info['previous_prices'].get(url, {})
+    subscriptions = user_info['subscriptions']
+    for i, url in enumerate(subscriptions, 1):
+        entry = product_catalog.get(product_key(url, user_info)) or {}
+        product_name = entry.get('name')
+        prices = entry.get('prices') or subscriptions[url]['seen']
         price_display = get_price_display(prices)
 
         if not product_name:
@@ -429,7 +2333,7 @@ def generate_product_list(user_info: dict) -> str:
 
         response.append(f"{i}. <a href='{url}'>{product_name}</a> (последняя цена: {price_display}₽)")
 
-    response.append(f"\nВсего: {len(user_info['urls'])}/{MAX_URLS_PER_USER}")
+    response.append(f"\nВсего: {len(subscriptions)}/{MAX_URLS_PER_USER}")
     return "\n".join(response)
 
 def compare_prices(previous: Optional[Dict[int, int]], current: Dict[int, int]) -> List[str]:
@@ -445,84 +2349,190 @@ def compare_prices(previous: Optional[Dict[int, int]], current: Dict[int, int])
             elif curr_price != prev_price:
                 diff = abs(curr_price - prev_price)
                 if curr_price > prev_price:
-                    changes.append(f"• Цена {price_names[idx]} ↗ {curr_price:,}₽ (+{diff:,}₽".replace(",", " "))
+                    changes.append(f"• Цена {price_names[idx]} ↗ {curr_price:,}₽ (+{diff:,}₽)".replace(",", " "))
                 else:
-                    changes.append(f"• Цена {price_names[idx]} ↘ {curr_price:,}₽ (-{diff:,}₽".replace(",", " "))
+                    changes.append(f"• Цена {price_names[idx]} ↘ {curr_price:,}₽ (-{diff:,}₽)".replace(",", " "))
             else:
                 changes.append(f"• Цена {price_names[idx]} не изменилась")
     else:
         changes.append("• Первая проверка цен")
     return changes
 
-async def check_prices(chat_id: str, force_notify: bool = False):
+async def stream_for_users(chat_ids: List[str]
+                           ) -> AsyncIterator[Tuple[str, Dict[str, Tuple[Optional[str], Dict[int, int], Optional[str], bool]]]]:
+    """
+    Загружает каждый уникальный товар один раз для группы пользователей.
+    Отдает (chat_id, {url: данные товара}), как только готовы все товары пользователя.
+    """
+    plan: Dict[str, str] = {}  # ключ товара -> url, по которому его загружаем
+    subscribers: Dict[str, List[Tuple[str, str]]] = {}  # ключ товара -> (chat_id, url подписки)
+    waiting: Dict[str, set] = {}
+    results: Dict[str, dict] = {}
+    for chat_id in chat_ids:
+        user_info = user_data.get(chat_id)
+        if not user_info:
+            continue
+        results[chat_id] = {}
+        waiting[chat_id] = set()
+        for url in user_info.get('subscriptions', {}):
+            key = product_key(url, user_info)
+            plan.setdefault(key, url)
+            subscribers.setdefault(key, []).append((chat_id, url))
+            waiting[chat_id].add(key)
+
+    total = sum(len(subs) for subs in subscribers.values())
+    logger.info(f"План проверки: {len(results)} польз., {total} подписок, {len(plan)} загрузок")
+    for chat_id in [chat_id for chat_id, keys in waiting.items() if not keys]:
+        yield chat_id, results[chat_id]
+
+    # Один url может быть загрузкой для двух ключей (артикул известен не всем подписчикам)
+    keys_by_url: Dict[str, List[str]] = {}
+    for key, url in plan.items():
+        keys_by_url.setdefault(url, []).append(key)
+    async for url, data in iter_fetch_products(list(keys_by_url), max_age=CHECK_MAX_STALENESS or None):
+        completed = []
+        for key in keys_by_url[url]:
+            for chat_id, subscription_url in subscribers[key]:
+                results[chat_id][subscription_url] = data
+                waiting[chat_id].discard(key)
+                if not waiting[chat_id] and chat_id not in completed:
+                    completed.append(chat_id)
+        for chat_id in completed:
+            yield chat_id, results[chat_id]
+
+def truncate_html(text: str, limit: int) -> str:
+    """
+    Обрезает HTML-текст до limit символов: по границе строки, если она есть, не внутри тега
+    или сущности, и закрывает оставшиеся открытыми теги — иначе Telegram отклонит разметку.
+    """
+    if len(text) <= limit:
+        return text
+    cut = limit - 1  # место под "…"
+    while cut > 0:
+        head = text[:cut]
+        if "\n" in head:
+            head = head[:head.rindex("\n")]
+        else:
+            if head.rfind("<") > head.rfind(">"):
+                head = head[:head.rindex("<")]
+            if head.rfind("&") > head.rfind(";"):
+                head = head[:head.rindex("&")]
+        open_tags = []
+        for closing, tag in HTML_TAG_RE.findall(head):
+            if not closing:
+                open_tags.append(tag)
+            elif tag in open_tags:
+                del open_tags[len(open_tags) - 1 - open_tags[::-1].index(tag)]
+        result = head + "…" + "".join(f"</{tag}>" for tag in reversed(open_tags))
+        if len(result) <= limit:
+            return result
+        cut = len(head) - (len(result) - limit)
+    return "…"
+
+def split_message(blocks: List[str], separator: str = "\n\n", limit: int = TELEGRAM_MESSAGE_LIMIT) -> List[str]:
+    """Собирает блоки в сообщения не длиннее limit, разрезая только между блоками"""
+    parts, current = [], ""
+    for block in blocks:
+        block = truncate_html(block, limit)
+        if current and len(current) + len(separator) + len(block) > limit:
+            parts.append(current)
+            current = block
+        else:
+            current = f"{current}{separator}{block}" if current else block
+    if current:
+        parts.append(current)
+    return parts
+
+def render_digest(user_info: dict,
+                  changed: List[Tuple[str, str, Dict[int, int], Optional[str], List[str], Optional[int]]],
+                  unchanged: List[Tuple[str, str, Dict[int, int]]]) -> List[str]:
+    """Сводка проверки: сначала изменившиеся товары подробно, затем остальные по строке"""
+    now = datetime.now()
+    blocks = [f"📊 <b>Проверка цен</b> {now.strftime('%H:%M %d.%m.%Y')}"]
+    for url, name, prices, full_sku, changes, lowest in changed:
+        lowest_text = f"\n📉 Минимум за 30 дней: {lowest:,}₽".replace(",", " ") if lowest else ""
+        blocks.append(
+            f"🛍️ <b>{html.escape(name)}</b>\n"
+            f"💳 {get_price_display(prices)}₽" + lowest_text + "\n"
+            f"📦 Артикул: {full_sku}\n"
+            f"🔗 <a href='{url}'>Ссылка на товар</a>\n" + "\n".join(changes)
+        )
+    if unchanged:
+        lines = [
+            f"▫️ <a href='{url}'>{html.escape(name)}</a> — {get_price_display(prices)}₽"
+            for url, name, prices in unchanged
+        ]
+        blocks.extend(split_message(["<b>Без изменений:</b>"] + lines, separator="\n"))
+    blocks.append(
+        "🔔 Режим: По изменению цены" if user_info['interval'] == 0 else
+        f"⏱️ Следующая проверка: {(now + timedelta(hours=user_info['interval'])).strftime('%H:%M %d.%m.%Y')}"
+    )
+    return split_message(blocks)
+
+async def check_prices(chat_id: str, force_notify: bool = False,
+                       products_data: Optional[Dict[str, Tuple[Optional[str], Dict[int, int], Optional[str], bool]]] = None):
+    """
+    Сравнивает цены с тем, что пользователь уже видел, и присылает одну сводку на проверку.
+    Плановые сводки уходят через очередь уведомлений, ручная проверка отвечает сразу.
+    """
     user_info = user_data.get(chat_id)
-    if not user_info or not user_info.get('urls') or not user_info.get('is_tracking', True):
+    if not user_info or not user_info.get('subscriptions') or not user_info.get('is_tracking', True):
         return
 
-    products_data = await batch_fetch_products(user_info['urls'])
+    urls = list(user_info['subscriptions'])
+    if products_data is None:
+        products_data = await batch_fetch_products(urls)
 
-    for url in user_info['urls']:
+    changed, unchanged = [], []
+    for url in urls:
+        subscription = user_info['subscriptions'].get(url)
         name, prices, full_sku, is_out_of_stock = products_data.get(url, (None, {}, None, True))
-        if not name or not prices or is_out_of_stock:
+        if not subscription or not name or not prices or is_out_of_stock:
             continue
 
-        user_info['product_names'][url] = name
-        previous = user_info['previous_prices'].get(url, {})
+        # Сравниваем с ценами, о которых пользователь уже знает, а не с общим каталогом
+        previous = subscription['seen']
         changes = compare_prices(previous, prices)
-        user_info['previous_prices'][url] = prices
-
-        # --- Главный фильтр для "По изменению цены" ---
-        if user_info['interval'] == 0 and not force_notify:
-            only_first_check = len(changes) == 1 and changes[0].startswith("• Первая проверка цен")
-            only_no_change = all(
-                (("не изменилась" in line) or ("Первая проверка цен" in line)) for line in changes
-            )
-            if only_first_check or only_no_change:
-                continue
-
-        if not force_notify and len(changes) == 1 and changes[0] == "• Первая проверка цен":
-            continue
-
-        card_price = prices.get(1, 'н/д')
-        regular_price = prices.get(2, card_price if card_price != 'н/д' else 'н/д')
-        interval_text = (
-            "🔔 Режим: По изменению цены" if user_info['interval'] == 0 else
-            f"⏱️ Следующая проверка: {(datetime.now() + timedelta(hours=user_info['interval'])).strftime('%H:%M %d.%m.%Y')}"
-        )
-
-        result = (
-            f"🛍️ <b>{name}</b>\n"
-            f"💳 {card_price:,}₽ | 🛒 {regular_price:,}₽\n".replace(",", " ") +
-            f"📦 Артикул: {full_sku}\n"
-            f"🔗 <a href='{url}'>Ссылка на товар</a>\n"
-            f"📅 {datetime.now().strftime('%H:%M %d.%m.%Y')}\n"
-            f"{interval_text}\n"
-            f"\n<b>Изменения:</b>\n" + "\n".join(changes)
-        )
+        if prices != previous:
+            mutate("price_update", chat_id, url=url, prices=prices)
+
+        if not previous:
+            # Первая проверка — уведомлять не о чем, кроме ручного запроса
+            if force_notify:
+                unchanged.append((url, name, prices))
+        elif prices != previous:
+            lowest = await price_history.lowest(full_sku or normalize_ozon_url(url))
+            changed.append((url, name, prices, full_sku, changes, lowest))
+        elif user_info['interval'] != 0 or force_notify:
+            # В режиме "По изменению цены" товары без изменений не присылаем
+            unchanged.append((url, name, prices))
+
+    if changed or unchanged:
+        parts = render_digest(user_info, changed, unchanged)
+        for i, text in enumerate(parts):
+            kwargs = dict(disable_web_page_preview=True, parse_mode="HTML")
+            if i == len(parts) - 1:
+                kwargs['reply_markup'] = ProductMenu.get_main_menu()
+            if force_notify:
+                try:
+                    await bot.send_message(chat_id, text, **kwargs)
+                except TelegramBadRequest as e:
+                    logger.error(f"Ошибка отправки: {e}")
+            else:
+                outbox.send_message(chat_id, text, **kwargs)
 
-        try:
-            await bot.send_message(
-                chat_id,
-                result,
-                disable_web_page_preview=True,
-                parse_mode="HTML",
-                reply_markup=ProductMenu.get_main_menu()
-            )
-            await asyncio.sleep(1)
-        except TelegramForbiddenError:
-            del user_data[chat_id]
-            save_user_data()
-            break
-        except TelegramBadRequest as e:
-            logger.error(f"Ошибка отправки: {e}")
-
-    user_info['last_active'] = datetime.now().isoformat()
-    save_user_data()
+    mutate("touch", chat_id)
 
 # =============================================
 # ОСНОВНЫЕ ОБРАБОТЧИКИ
 # =============================================
 
+@router.message.outer_middleware()
+async def upgrade_user_middleware(handler, event: types.Message, data: dict):
+    """Пока идет фоновая миграция, запись пишущего пользователя мигрируется вне очереди"""
+    upgrade_user(str(event.chat.id))
+    return await handler(event, data)
+
 @router.message(Command("start"))
 async def cmd_start(message: types.Message):
     chat_id = str(message.chat.id)
@@ -530,16 +2540,14 @@ async def cmd_start(message: types.Message):
 
     # Инициализация данных пользователя, если их нет
     if chat_id not in user_data:
-        user_data[chat_id] = {
-            'urls': [],
-            'previous_prices': {},
-            'product_names': {},
+        mutate("create_user", chat_id, user={
+            'subscriptions': {},
+            'schema': SCHEMA_VERSION,
             'last_active': datetime.now().isoformat(),
             'interval': DEFAULT_INTERVAL,
             'last_check': None,
             'is_tracking': True
-        }
-        save_user_data()
+        })
 
     await message.answer(
         "👋 <b>Добро пожаловать в Ozon Price Tracker!</b>\n\n"
@@ -584,7 +2592,7 @@ async def cmd_help(message: types.Message):
 
         "3. <b>Настройка интервала:</b>\n"
         "   - ⏱️ Интервал проверки - выбирайте из предложенных\n"
-        "   - 🔔 Режим 'По изменению цены': бот проверяет товары каждый час "
+        "   - 🔔 Режим 'По изменению цены': бот чаще проверяет товары, цена которых часто меняется, "
         "и присылает уведомления ТОЛЬКО при изменении цены\n\n"
 
         "4. <b>Ручная проверка:</b>\n"
@@ -623,7 +2631,7 @@ async def check_menu(message: types.Message):
 async def list_urls(message: types.Message):
     log_action(message.from_user, "Просмотр списка товаров")
     chat_id = str(message.chat.id)
-    if chat_id not in user_data or not user_data[chat_id].get('urls'):
+    if chat_id not in user_data or not user_data[chat_id].get('subscriptions'):
         await message.answer("📭 Список пуст", reply_markup=ProductMenu.get_main_menu())
         return
 
@@ -649,7 +2657,7 @@ async def add_url_command(message: types.Message, state: FSMContext):
         return
 
     user_info = user_data[chat_id]
-    if len(user_info['urls']) >= MAX_URLS_PER_USER:
+    if len(user_info['subscriptions']) >= MAX_URLS_PER_USER:
         await message.answer(f"❌ Лимит {MAX_URLS_PER_USER} товаров!", reply_markup=ProductMenu.get_main_menu())
         return
 
@@ -659,100 +2667,100 @@ async def add_url_command(message: types.Message, state: FSMContext):
         reply_markup=ProductMenu.get_back_button()
     )
 
-@router.message(Form.add_url)
-async def add_url_state(message: types.Message, state: FSMContext):
-    user = message.from_user
-    chat_id = str(message.chat.id)
-    user_info = user_data.get(chat_id, {})
-    temp_messages = []
+add_tasks: set = set()  # ссылки на фоновые добавления, чтобы задачи не собрал GC
 
+def extract_ozon_link(text: Optional[str]) -> Optional[str]:
+    """Первая ссылка на товар Ozon в тексте, приведенная к каноническому виду без сетевых запросов"""
+    match = OZON_LINK_RE.search(text or "")
+    if not match:
+        return None
+    url = match.group(0)
+    if not url.startswith("http"):
+        url = "https://" + url  # Автоматически добавляем https
+    return canonical_product_url(url) or url
+
+async def load_for_add(url: str) -> Tuple[str, Tuple[Optional[str], Dict[int, int], Optional[str], bool]]:
+    url = await resolve_short_link(url)
+    products_data = await batch_fetch_products([url], max_age=PRODUCT_CACHE_TTL)
+    data = products_data.get(url, (None, {}, None, True))
+    return short_links.get(url) or url, data  # браузер мог раскрыть ссылку, которую не раскрыл HTTP
+
+async def add_product(chat_id: str, url: str, status: Message):
+    """Фоновая часть добавления: загрузка, проверка дублей и сохранение; итог — одной правкой статуса"""
     try:
-        temp_messages.append(message.message_id)
-        loading_msg = await message.answer("⏳ <i>Инициализация проверки...</i>", parse_mode="HTML")
-        temp_messages.append(loading_msg.message_id)
-
-        url = message.text.strip()
-        if url.startswith('ozon.ru/t/'):
-            url = 'https://' + url  # Автоматически добавляем https
-        log_action(user, "Попытка добавления товара", product_url=url)
-
-        # Проверка формата ссылки
-        await loading_msg.edit_text("⏳ <i>Проверка формата ссылки...</i>", parse_mode="HTML")
-        await asyncio.sleep(0.5)
-        if not re.match(r'^https?://(www\.)?ozon\.(ru|by)/(product/|t/)', url):
-            await show_animation(loading_msg, "❌ Неверный формат!")
-            await delete_messages(chat_id, temp_messages)
-            return await show_main_menu(message)
-
-        # Получение данных с сайта
-        await loading_msg.edit_text("⏳ <i>Проверка на дубликаты...</i>", parse_mode="HTML")
-        products_data = await batch_fetch_products([url])
-        name, prices, full_sku, is_out_of_stock = products_data.get(url, (None, {}, None, True))
-
-        if not all([name, prices, full_sku]):
-            await show_animation(loading_msg, "⚠️ Не удалось получить данные!")
-            await delete_messages(chat_id, temp_messages)
-            return await show_main_menu(message)
-
+        url, (name, prices, full_sku, is_out_of_stock) = await load_for_add(url)
+        user_info = user_data.get(chat_id)
+        if not user_info:
+            return
+        dupe_reason = is_duplicate(url, full_sku, chat_id)
         if not full_sku:
-            await show_animation(loading_msg, "❌ Не удалось получить артикул!")
-            await delete_messages(chat_id, temp_messages)
-            return await show_main_menu(message)
-
-        # Проверка на дубль по артикулу (full_sku) и url
-        dupe_reason = is_duplicate(url, full_sku, user_info)
-        if dupe_reason:
-            await show_animation(loading_msg, dupe_reason)
-            await delete_messages(chat_id, temp_messages)
-            return await show_main_menu(message)
-
-        # Проверка наличия товара
-        await loading_msg.edit_text("⏳ <i>Проверка наличия товара...</i>", parse_mode="HTML")
-        if is_out_of_stock:
-            await show_animation(loading_msg, "🚫 Товар закончился!")
-            await delete_messages(chat_id, temp_messages)
-            return await show_main_menu(message)
-
-        if not name or not prices:
-            await show_animation(loading_msg, "⚠️ Ошибка данных!")
-            await delete_messages(chat_id, temp_messages)
-            return await show_main_menu(message)
-
-        # Успешное добавление
-        user_info.setdefault('urls', []).append(url)
-        user_info.setdefault('product_names', {})[url] = name
-        user_info.setdefault('previous_prices', {})[url] = prices
-        user_info.setdefault('skus', {})[full_sku] = url
-        user_info['last_active'] = datetime.now().isoformat()
-        save_user_data()
-
-        success_text = (
-            f"✅ <b>Товар добавлен!</b>\n"
-            f"🏷 {name}\n"
-            f"📦 Артикул: <code>{full_sku}</code>\n"
-            f"💵 {get_price_display(prices)}₽\n"
-            f"🔗 <a href='{url}'>Ссылка на товар</a>\n"
-            f"⏱️ Режим проверки: {format_interval(user_info.get('interval', DEFAULT_INTERVAL))}"
-        )
+            text = "❌ Не удалось получить артикул!"
+        elif dupe_reason:
+            text = dupe_reason
+        elif is_out_of_stock:
+            text = "🚫 Товар закончился!"
+        elif not name or not prices:
+            text = "⚠️ Ошибка данных!"
+        elif len(user_info['subscriptions']) >= MAX_URLS_PER_USER:
+            # Пока товар загружался, пользователь мог добавить другие
+            text = f"❌ Лимит {MAX_URLS_PER_USER} товаров!"
+        else:
+            mutate("add_url", chat_id, url=url, sku=full_sku, prices=prices)
+            text = (
+                f"✅ <b>Товар добавлен!</b>\n"
+                f"🏷 {html.escape(name)}\n"
+                f"📦 Артикул: <code>{full_sku}</code>\n"
+                f"💵 {get_price_display(prices)}₽\n"
+                f"🔗 <a href='{url}'>Ссылка на товар</a>\n"
+                f"⏱️ Режим проверки: {format_interval(user_info.get('interval', DEFAULT_INTERVAL))}"
+            )
+    except Exception as e:
+        logger.error(f"Ошибка добавления {url}: {e}", exc_info=True)
+        text = "⚠️ Произошла ошибка при обработке ссылки"
 
-        success_msg = await message.answer(
-            success_text,
-            parse_mode="HTML",
-            disable_web_page_preview=True,
-            reply_markup=ProductMenu.get_main_menu()
-        )
+    try:
+        await status.edit_text(text, parse_mode="HTML", disable_web_page_preview=True)
+    except TelegramBadRequest as e:
+        logger.warning(f"Не удалось обновить статус добавления: {e}")
 
-        await animate_success(success_msg)
-        await delete_messages(chat_id, temp_messages)
+async def start_add(message: types.Message, url: str):
+    """
+    Общая точка добавления товара: проверки без сети и сразу ответ пользователю,
+    загрузка товара идет в фоне и заканчивается правкой этого ответа.
+    """
+    chat_id = str(message.chat.id)
+    user_info = user_data.get(chat_id)
+    if not user_info:
+        await message.answer("❌ Сначала запустите бота командой /start", reply_markup=ProductMenu.get_main_menu())
+        return
+    if len(user_info['subscriptions']) >= MAX_URLS_PER_USER:
+        await message.answer(f"❌ Лимит {MAX_URLS_PER_USER} товаров!", reply_markup=ProductMenu.get_main_menu())
+        return
 
-    except Exception as e:
-        logger.error(f"Ошибка: {str(e)}", exc_info=True)
-        await delete_messages(chat_id, temp_messages)
-        await message.answer("⚠️ Произошла ошибка", reply_markup=ProductMenu.get_main_menu())
-    finally:
-        await state.clear()
+    log_action(message.from_user, "Попытка добавления товара", product_url=url)
+    # Ссылка, которая уже есть в списке, отсекается без загрузки; дубль по артикулу — после нее
+    dupe_reason = is_duplicate(url, None, chat_id)
+    if dupe_reason:
+        await message.answer(dupe_reason, reply_markup=ProductMenu.get_main_menu())
+        return
 
+    status = await message.answer(
+        "⏳ <i>Добавляю товар, это займет несколько секунд…</i>",
+        parse_mode="HTML",
+        reply_markup=ProductMenu.get_main_menu()
+    )
+    task = asyncio.create_task(add_product(chat_id, url, status))
+    add_tasks.add(task)
+    task.add_done_callback(add_tasks.discard)
 
+@router.message(Form.add_url)
+async def add_url_state(message: types.Message, state: FSMContext):
+    await state.clear()
+    url = extract_ozon_link(message.text)
+    if not url:
+        await message.answer("❌ Неверный формат ссылки!", reply_markup=ProductMenu.get_main_menu())
+        return
+    await start_add(message, url)
 
 # =============================================
 # ОБРАБОТЧИКИ УДАЛЕНИЯ ТОВАРОВ
@@ -764,7 +2772,7 @@ async def remove_url_menu(message: types.Message, state: FSMContext):
     chat_id = str(message.chat.id)
     user_info = user_data.get(chat_id)
 
-    if not user_info or not user_info.get('urls'):
+    if not user_info or not user_info.get('subscriptions'):
         await message.answer("❌ Нет отслеживаемых товаров!", reply_markup=ProductMenu.get_main_menu())
         return
 
@@ -778,8 +2786,8 @@ async def remove_url_menu(message: types.Message, state: FSMContext):
     await message.answer(
         "Выберите товар для удаления:",
         reply_markup=ProductMenu.get_remove_menu(
-            user_info['urls'],
-            user_info['product_names']
+            list(user_info['subscriptions']),
+            subscription_names(user_info)
         )
     )
     await state.set_state(Form.remove_url)
@@ -801,7 +2809,7 @@ async def remove_single_product(message: types.Message, state: FSMContext):
     chat_id = str(message.chat.id)
     user_info = user_data.get(chat_id)
 
-    if not user_info or not user_info.get('urls'):
+    if not user_info or not user_info.get('subscriptions'):
         await message.answer("❌ Нет товаров для удаления!", reply_markup=ProductMenu.get_main_menu())
         return
 
@@ -809,51 +2817,40 @@ async def remove_single_product(message: types.Message, state: FSMContext):
     if not match:
         await message.answer("❌ Ошибка распознавания номера!",
                            reply_markup=ProductMenu.get_remove_menu(
-                               user_info['urls'],
-                               user_info['product_names']
+                               list(user_info['subscriptions']),
+                               subscription_names(user_info)
                            ))
         return
 
     try:
         product_num = int(match.group(1))
-        if 1 <= product_num <= len(user_info['urls']):
-            removed_url = user_info['urls'].pop(product_num - 1)
-
-            # Удаление артикула (артикул = ключ, url = значение)
-            sku_to_delete = None
-            for sku, url in list(user_info['skus'].items()):
-                if url == removed_url:
-                    sku_to_delete = sku
-                    break
-            if sku_to_delete:
-                del user_info['skus'][sku_to_delete]
-
-            product_name = user_info['product_names'].get(removed_url, "Неизвестно")
-            user_info['previous_prices'].pop(removed_url, None)
-            user_info['product_names'].pop(removed_url, None)
-            user_info['last_active'] = datetime.now().isoformat()
-            save_user_data()
+        urls = list(user_info['subscriptions'])
+        if 1 <= product_num <= len(urls):
+            removed_url = urls[product_num - 1]
+            removed_sku = user_info['subscriptions'][removed_url].get('sku')
+            product_name = subscription_names(user_info).get(removed_url, "Неизвестно")
+            mutate("remove_url", chat_id, url=removed_url)
 
             log_action(
                 user=user,
                 action="Товар удален",
                 product_name=product_name,
                 product_url=removed_url,
-                sku=sku
+                sku=removed_sku
             )
             await message.answer("🗑️ Товар удален!", reply_markup=ProductMenu.get_main_menu())
             await state.clear()
         else:
             await message.answer("❌ Неверный номер товара!",
                                reply_markup=ProductMenu.get_remove_menu(
-                                   user_info['urls'],
-                                   user_info['product_names']
+                                   list(user_info['subscriptions']),
+                                   subscription_names(user_info)
                                ))
     except (ValueError, IndexError):
         await message.answer("❌ Неверный номер товара!",
                            reply_markup=ProductMenu.get_remove_menu(
-                               user_info['urls'],
-                               user_info['product_names']
+                               list(user_info['subscriptions']),
+                               subscription_names(user_info)
                            ))
 
 async def remove_all_products(message: types.Message, state: FSMContext):
@@ -861,16 +2858,11 @@ async def remove_all_products(message: types.Message, state: FSMContext):
     chat_id = str(message.chat.id)
     user_info = user_data.get(chat_id)
 
-    if not user_info or not user_info.get('urls'):
+    if not user_info or not user_info.get('subscriptions'):
         await message.answer("❌ Нет товаров для удаления!", reply_markup=ProductMenu.get_main_menu())
         return
 
-    user_info['urls'].clear()
-    user_info['previous_prices'].clear()
-    user_info['product_names'].clear()
-    user_info['skus'].clear()  # <--- добавить это!
-    user_info['last_active'] = datetime.now().isoformat()
-    save_user_data()
+    mutate("clear_urls", chat_id)
 
     log_action(user, "Все товары удалены")
     await message.answer("✅ Все товары удалены!", reply_markup=ProductMenu.get_main_menu())
@@ -899,36 +2891,74 @@ async def set_interval_value(message: types.Message):
         return
 
     interval = next(k for k, v in INTERVAL_NAMES.items() if v == message.text)
-    user_data[chat_id]['interval'] = interval
-    user_data[chat_id]['last_active'] = datetime.now().isoformat()
-    save_user_data()
+    mutate("set_interval", chat_id, interval=interval)
 
     log_action(user, f"Установлен интервал: {format_interval(interval)}")
-    response = ("✅ Режим проверки: По изменению цены\n• Проверка каждый час\n• Уведомления только при изменениях"
+    response = ("✅ Режим проверки: По изменению цены\n• Частота проверки подстраивается под товар\n• Уведомления только при изменениях"
                 if interval == 0 else
                 f"✅ Интервал: каждые {format_interval(interval)}")
     await message.answer(response, reply_markup=ProductMenu.get_main_menu())
 
+@router.message(F.text.in_({"⏸️ Прекратить отслеживание", "▶️ Возобновить отслеживание"}))
+async def toggle_tracking(message: types.Message):
+    chat_id = str(message.chat.id)
+    if chat_id not in user_data:
+        await message.answer("❌ Сначала запустите бота /start", reply_markup=ProductMenu.get_main_menu())
+        return
+
+    is_tracking = message.text.startswith("▶️")
+    mutate("set_tracking", chat_id, is_tracking=is_tracking)
+
+    log_action(message.from_user, "Отслеживание возобновлено" if is_tracking else "Отслеживание приостановлено")
+    response = ("▶️ Отслеживание возобновлено" if is_tracking else
+                "⏸ Отслеживание приостановлено. Проверки не выполняются до возобновления.")
+    await message.answer(response, reply_markup=ProductMenu.get_main_menu())
+
 # =============================================
 # ДОПОЛНИТЕЛЬНЫЕ ОБРАБОТЧИКИ
 # =============================================
 
+def progress_line(url: str, data: Tuple[Optional[str], Dict[int, int], Optional[str], bool]) -> str:
+    name, prices, _, is_out_of_stock = data
+    if not name:
+        return f"⚠️ <a href='{url}'>Товар</a> — не удалось загрузить"
+    if is_out_of_stock or not prices:
+        return f"🚫 {html.escape(name)} — нет в наличии"
+    return f"▫️ {html.escape(name)} — {get_price_display(prices)}₽"
+
 @router.message(Command("check"))
 @router.message(F.text == "🔄 Проверить сейчас")
 async def manual_check(message: types.Message):
     log_action(message.from_user, "Ручная проверка цен")
     chat_id = str(message.chat.id)
-    if chat_id not in user_data or not user_data[chat_id].get('urls'):
+    if chat_id not in user_data or not user_data[chat_id].get('subscriptions'):
         await message.answer("❌ Нет товаров для проверки!", reply_markup=ProductMenu.get_main_menu())
         return
 
-    msg = await message.answer("⏳ Запрашиваю актуальные цены... Это может занять некоторое время.", parse_mode="HTML")
-    user_data[chat_id]['last_active'] = datetime.now().isoformat()
-    save_user_data()
+    urls = list(user_data[chat_id]['subscriptions'])
+    msg = await message.answer(f"⏳ Запрашиваю актуальные цены: 0 из {len(urls)}", parse_mode="HTML")
+    mutate("touch", chat_id)
+
+    # Товары показываются в сообщении о ходе проверки по мере загрузки, сводка — в конце
+    products_data, lines, last_edit = {}, [], 0.0
+    async for url, data in iter_fetch_products(urls):
+        products_data[url] = data
+        lines.append(progress_line(url, data))
+        done = len(products_data) == len(urls)
+        if done or time.monotonic() - last_edit >= MANUAL_PROGRESS_INTERVAL:
+            last_edit = time.monotonic()
+            header = "✅ Цены получены" if done else "⏳ Запрашиваю актуальные цены"
+            try:
+                await msg.edit_text(
+                    f"{header}: {len(products_data)} из {len(urls)}\n\n" + "\n".join(lines),
+                    parse_mode="HTML",
+                    disable_web_page_preview=True
+                )
+            except TelegramBadRequest as e:
+                logger.warning(f"Не удалось обновить ход проверки: {e}")
 
-    await check_prices(chat_id, force_notify=True)
-    user_data[chat_id]['last_check'] = datetime.now().isoformat()
-    save_user_data()
+    await check_prices(chat_id, force_notify=True, products_data=products_data)
+    mutate("checked", chat_id, last_check=datetime.now().isoformat())
 
     try: await bot.delete_message(chat_id, msg.message_id)
     except: pass
@@ -952,7 +2982,7 @@ async def show_stats(message: types.Message):
         f"• Статус отслеживания: {tracking_status}\n"
         f"• Интервал проверки: {format_interval(interval)}\n"
         f"• Последняя проверка: {last_check[:16] if last_check else 'еще не было'}\n"
-        f"• Отслеживается товаров: {len(user_info.get('urls', []))}\n"
+        f"• Отслеживается товаров: {len(user_info.get('subscriptions', {}))}\n"
         f"• Максимум товаров: {MAX_URLS_PER_USER}"
     )
     await message.answer(stats_message, parse_mode="HTML", reply_markup=ProductMenu.get_main_menu())
@@ -974,277 +3004,533 @@ async def send_logs(message: types.Message):
     except Exception as e:
         await message.answer(f"❌ Ошибка получения логов: {str(e)}")
 
-@router.message(F.text.regexp(r'^https?://(www\.)?ozon\.(ru|by)/(product/|t/)'))
-async def handle_direct_link(message: types.Message):
-    chat_id = str(message.chat.id)
-    user = message.from_user
-    user_info = user_data.get(chat_id)
-    temp_messages = []
-
-    try:
-        # Проверка наличия текста сообщения
-        if not message.text:
-            await message.answer("❌ Не получена ссылка")
-            return
-
-        url = message.text.strip()
-        if url.startswith('ozon.ru/t/'):
-            url = 'https://' + url
-        temp_messages.append(message.message_id)
-
-        # Проверка инициализации пользователя
-        if not user_info:
-            await message.answer("❌ Сначала запустите бота командой /start",
-                               reply_markup=ProductMenu.get_main_menu())
-            return
-
-        # Проверка лимита товаров
-        if len(user_info['urls']) >= MAX_URLS_PER_USER:
-            await message.answer(f"❌ Лимит {MAX_URLS_PER_USER} товаров!",
-                               reply_markup=ProductMenu.get_main_menu())
-            return
-
-        loading_msg = await message.answer("⏳ <i>Проверка ссылки...</i>", parse_mode="HTML")
-        temp_messages.append(loading_msg.message_id)
-
-        log_action(user, "Попытка добавления товара (прямая ссылка)", product_url=url)
+@router.message(Command("perf"))
+async def show_perf(message: types.Message):
+    if message.from_user.id != OWNER_ID:
+        return
 
-        # Проверка формата ссылки уже есть в роутере
+    report = (
+        f"⚙️ <b>Производительность:</b>\n\n"
+        f"• Кэш товаров: {product_cache.stats()}\n"
+        f"• Загрузки в процессе: {single_flight.stats()}\n"
+        f"• Хранилище: {STORAGE_BACKEND}, записей {store_flusher.writes}, ожидают {len(store_flusher.dirty)}\n"
+        f"• Каталог: {len(product_catalog)} товаров, "
+        f"{sum(len(u.get('subscriptions', ())) for u in user_data.values())} подписок\n"
+        f"• Проверки: {due_scheduler.stats()}\n"
+        f"• Пул проверок: {check_pool.stats()}\n"
+        f"• Telegram: {outbox.stats()}\n"
+        f"• По изменению цены: {adaptive_poller.stats()}, в очереди {len(product_scheduler.due_at)}\n"
+        f"• Драйверы: запущено {driver_pool.created}, пересоздано {driver_pool.recycled}\n"
+        + "\n".join(fetch_metrics.report() + [f"• {t.stats()}" for t in domain_throttles.values()])
+    )
+    await message.answer(report, parse_mode="HTML")
 
-        await loading_msg.edit_text("⏳ <i>Проверка на дубликаты...</i>", parse_mode="HTML")
-        products_data = await batch_fetch_products([url])
-        name, prices, full_sku, is_out_of_stock = products_data.get(url, (None, {}, None, True))
+# Ссылка на товар в любом сообщении — добавление, остальные сообщения удаляются
+@router.message()
+async def handle_any_message(message: types.Message):
+    url = extract_ozon_link(message.text)
+    if url:
+        await start_add(message, url)
+        return
+    # Если ссылки Ozon нет — просто удаляем сообщение без лишнего шума
+    try:
+        await bot.delete_message(message.chat.id, message.message_id)
+    except Exception:
+        pass
 
-        if not full_sku:
-            await show_animation(loading_msg, "❌ Не удалось получить артикул!")
-            await delete_messages(chat_id, temp_messages)
-            return await show_main_menu(message)
-
-        # ВАЖНО: Проверка дубля по артикула!
-        dupe_reason = is_duplicate(url, full_sku, user_info)
-        if dupe_reason:
-            await show_animation(loading_msg, dupe_reason)
-            await delete_messages(chat_id, temp_messages)
-            return await show_main_menu(message)
-
-        # Проверка наличия товара
-        await loading_msg.edit_text("⏳ <i>Проверка наличия товара...</i>", parse_mode="HTML")
-        if is_out_of_stock:
-            await show_animation(loading_msg, "🚫 Товар закончился!")
-            await delete_messages(chat_id, temp_messages)
-            return await show_main_menu(message)
-
-        if not name or not prices:
-            await show_animation(loading_msg, "⚠️ Ошибка данных!")
-            await delete_messages(chat_id, temp_messages)
-            return await show_main_menu(message)
-
-        # Успешное добавление
-        user_info.setdefault('urls', []).append(url)
-        user_info.setdefault('product_names', {})[url] = name
-        user_info.setdefault('previous_prices', {})[url] = prices
-        user_info.setdefault('skus', {})[full_sku] = url
-        user_info['last_active'] = datetime.now().isoformat()
-        save_user_data()
+# =============================================
+# ПЛАНИРОВЩИК И ЗАПУСК
+# =============================================
 
-        success_text = (
-            f"✅ <b>Товар добавлен!</b>\n"
-            f"🏷 {name}\n"
-            f"📦 Артикул: <code>{full_sku}</code>\n"
-            f"💵 {get_price_display(prices)}₽\n"
-            f"🔗 <a href='{url}'>Ссылка на товар</a>\n"
-            f"⏱️ Режим проверки: {format_interval(user_info.get('interval', DEFAULT_INTERVAL))}"
+class CheckPool:
+    """
+    Ограниченный пул асинхронных воркеров для проверок пользователей.
+    У каждой задачи свой срок: зависшая проверка отменяется и не задерживает очередь.
+    У одного пользователя может быть несколько задач сразу (товары режима "По изменению цены").
+    """
+    def __init__(self, workers: int, timeout: float):
+        self.workers = workers
+        self.timeout = timeout
+        self.queue: "asyncio.Queue[Tuple[float, str, Callable[[], Awaitable]]]" = asyncio.Queue()
+        self.active: Dict[str, set] = {}  # chat_id -> выполняющиеся задачи
+        self.pending: Dict[str, int] = {}  # chat_id -> задач в очереди и в работе
+        self.completed = self.timed_out = self.cancelled = self.failed = 0
+        self.waits = deque(maxlen=200)  # время в очереди, секунды
+        self.durations = deque(maxlen=200)
+        self._workers: List[asyncio.Task] = []
+
+    def start(self):
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        for tasks in self.active.values():
+            for task in tasks:
+                task.cancel()
+
+    def submit(self, chat_id: str, job: Callable[[], Awaitable]):
+        self.pending[chat_id] = self.pending.get(chat_id, 0) + 1
+        self.queue.put_nowait((time.monotonic(), chat_id, job))
+
+    def busy(self, chat_id: str) -> bool:
+        """Есть ли у пользователя проверка в очереди или в работе"""
+        return chat_id in self.pending
+
+    def cancel(self, chat_id: str):
+        """Отменяет выполняющиеся проверки пользователя; задачи в очереди сами увидят, что проверять нечего"""
+        for task in list(self.active.get(chat_id, ())):
+            if task is not asyncio.current_task():
+                task.cancel()
+
+    async def _work(self):
+        while True:
+            enqueued, chat_id, job = await self.queue.get()
+            started = time.monotonic()
+            self.waits.append(started - enqueued)
+            task = asyncio.create_task(job())
+            self.active.setdefault(chat_id, set()).add(task)
+            try:
+                await asyncio.wait_for(task, self.timeout)
+                self.completed += 1
+            except asyncio.TimeoutError:
+                self.timed_out += 1
+                logger.warning(f"Проверка {chat_id} прервана: дольше {self.timeout} с")
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling():
+                    raise
+                self.cancelled += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Ошибка проверки {chat_id}: {e}")
+            finally:
+                self.durations.append(time.monotonic() - started)
+                tasks = self.active.get(chat_id)
+                tasks.discard(task)
+                if not tasks:
+                    del self.active[chat_id]
+                self.pending[chat_id] -= 1
+                if not self.pending[chat_id]:
+                    del self.pending[chat_id]
+                self.queue.task_done()
+
+    def stats(self) -> str:
+        avg_wait = sum(self.waits) / len(self.waits) if self.waits else 0
+        avg_run = sum(self.durations) / len(self.durations) if self.durations else 0
+        running = sum(len(tasks) for tasks in self.active.values())
+        return (
+            f"воркеров {self.workers}, в очереди {self.queue.qsize()}, выполняется {running}, "
+            f"ожидание {avg_wait:.1f} с, проверка {avg_run:.1f} с, "
+            f"готово {self.completed}, просрочено {self.timed_out}, отменено {self.cancelled}, ошибок {self.failed}"
         )
 
-        success_msg = await message.answer(
-            success_text,
-            parse_mode="HTML",
-            disable_web_page_preview=True,
-            reply_markup=ProductMenu.get_main_menu()
-        )
+check_pool = CheckPool(CHECK_WORKERS, CHECK_JOB_TIMEOUT)
 
-        await animate_success(success_msg)
-        await asyncio.sleep(1)
-        await delete_messages(chat_id, temp_messages)
+class DueScheduler:
+    """
+    Очередь проверок по сроку: куча (время, chat_id) и сон до ближайшего срока.
+    Актуальный срок пользователя хранится в due_at, устаревшие записи кучи отбрасываются при извлечении.
+    Кого пачка не вернула в расписание (сбой или отмена run_batch), возвращает reschedule.
+    """
+    def __init__(self, run_batch: Callable[[List[Tuple[str, float]]], Any], reschedule: Callable[[str], Any]):
+        self.run_batch = run_batch
+        self.reschedule = reschedule
+        self.due_at: Dict[str, float] = {}
+        self.dispatched = 0
+        self.lag = deque(maxlen=200)  # опоздание запуска относительно срока, секунды
+        self._heap: List[Tuple[float, str]] = []
+        self._wakeup = asyncio.Event()
+        self._running: set = set()  # ссылки на запущенные пачки, чтобы задачи не собрал GC
+
+    def schedule(self, chat_id: str, when: float):
+        self.due_at[chat_id] = when
+        heapq.heappush(self._heap, (when, chat_id))
+        if self._heap[0] == (when, chat_id):
+            # Новый ближайший срок — будим цикл, чтобы он пересчитал сон
+            self._wakeup.set()
+        if len(self._heap) > 2 * len(self.due_at) + 64:
+            self._heap = [(when, chat_id) for chat_id, when in self.due_at.items()]
+            heapq.heapify(self._heap)
+
+    def cancel(self, chat_id: str):
+        self.due_at.pop(chat_id, None)
+
+    def postpone(self, chat_id: str, delay: float):
+        """Отодвигает срок, уже наступивший для прерванной проверки, чтобы сбой не крутил повторы без паузы"""
+        when = self.due_at.get(chat_id)
+        if when is not None and when < time.time() + delay:
+            self.schedule(chat_id, time.time() + delay)
+
+    def _pop_due(self, now: float) -> List[Tuple[str, float]]:
+        batch = []
+        while self._heap and self._heap[0][0] <= now:
+            when, chat_id = heapq.heappop(self._heap)
+            if self.due_at.get(chat_id) != when:
+                continue
+            del self.due_at[chat_id]
+            batch.append((chat_id, when))
+            self.lag.append(now - when)
+        return batch
 
-    except Exception as e:
-        logger.error(f"Ошибка при обработке ссылки: {e}")
-        await delete_messages(chat_id, temp_messages)
-        await message.answer("⚠️ Произошла ошибка при обработке ссылки",
-                           reply_markup=ProductMenu.get_main_menu())
+    async def _dispatch(self, batch: List[Tuple[str, float]]):
+        try:
+            await self.run_batch(batch)
+        except Exception as e:
+            logger.error(f"Ошибка плановой проверки: {e}")
+        finally:
+            # Срок удален из due_at при извлечении — без этого выпавшие из пачки остались бы без расписания
+            for chat_id, _ in batch:
+                if chat_id not in self.due_at:
+                    self.reschedule(chat_id)
+                    self.postpone(chat_id, CHECK_RETRY_DELAY)
+
+    async def run(self):
+        while True:
+            now = time.time()
+            batch = self._pop_due(now)
+            if batch:
+                self.dispatched += len(batch)
+                task = asyncio.create_task(self._dispatch(batch))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
 
-# Обработчик для удаления неподдерживаемых сообщений
-@router.message()
-async def handle_any_message(message: types.Message):
-    text = message.text or ""
-    url_match = OZON_LINK_RE.search(text)
-    if url_match:
-        url = url_match.group(0)
-        chat_id = str(message.chat.id)
-        user = message.from_user
-        user_info = user_data.get(chat_id)
-        temp_messages = []
+    def stats(self) -> str:
+        avg_lag = sum(self.lag) / len(self.lag) if self.lag else 0
+        return f"в очереди {len(self.due_at)}, запущено {self.dispatched}, опоздание {avg_lag:.1f} с"
 
-        # Лимиты и первичная проверка
-        if not user_info:
-            await message.answer("❌ Сначала запустите бота командой /start",
-                                 reply_markup=ProductMenu.get_main_menu())
+class AdaptivePoller:
+    """
+    Частота проверки товара в режиме "По изменению цены" по истории изменений его цены:
+    начальный интервал — четверть среднего промежутка между изменениями за ADAPTIVE_HISTORY_DAYS
+    (без изменений в истории — ADAPTIVE_START_MINUTES, прежний шаг режима),
+    дальше изменение цены сокращает интервал вдвое, проверка без изменений удлиняет его на четверть.
+    Если сумма запланированных загрузок превышает FETCH_BUDGET_PER_HOUR, все интервалы растягиваются.
+    """
+    def __init__(self):
+        self.intervals: Dict[str, float] = {}  # ключ товара -> интервал, секунды
+        self.last_prices: Dict[str, Dict[int, int]] = {}
+        self.in_flight: set = set()
+        self.demand = 0.0  # запланировано загрузок в час
+        self.fetches: "deque[float]" = deque()  # время загрузок за последний час
+        self.changes = 0
+        self.seeding: set = set()  # ссылки на фоновые чтения истории
+
+    def _set(self, key: str, interval: float):
+        interval = min(max(interval, ADAPTIVE_MIN_MINUTES * 60), ADAPTIVE_MAX_MINUTES * 60)
+        self.demand += 3600 / interval - 3600 / self.intervals.get(key, float("inf"))
+        self.intervals[key] = interval
+
+    def interval(self, key: str) -> float:
+        if key not in self.intervals:
+            # История еще не прочитана (см. seed) — начинаем с прежнего шага режима
+            self._set(key, ADAPTIVE_START_MINUTES * 60)
+        return self.intervals[key]
+
+    async def seed(self, keys):
+        """Начальные интервалы по истории цен; файлы истории читаются в отдельном потоке"""
+        keys = [key for key in keys if key not in self.intervals]
+        initial = await asyncio.to_thread(lambda: {key: self._initial_interval(key) for key in keys})
+        for key, interval in initial.items():
+            if key not in self.intervals:
+                self._set(key, interval)
+
+    def _initial_interval(self, key: str) -> float:
+        points = price_history.query(key, datetime.now() - timedelta(days=ADAPTIVE_HISTORY_DAYS))
+        changes = sum(1 for a, b in zip(points, points[1:]) if a[1:3] != b[1:3])
+        if not changes:
+            # До потолка интервал дорастет сам, если проверки не увидят изменений
+            return ADAPTIVE_START_MINUTES * 60
+        return (points[-1][0] - points[0][0]) / changes / 4
+
+    def observe(self, key: str, prices: Dict[int, int]):
+        """Учитывает результат загрузки товара"""
+        now = time.time()
+        self.fetches.append(now)
+        while self.fetches and self.fetches[0] < now - 3600:
+            self.fetches.popleft()
+        if not prices:
             return
-
-        if len(user_info['urls']) >= MAX_URLS_PER_USER:
-            await message.answer(f"❌ Лимит {MAX_URLS_PER_USER} товаров!",
-                                 reply_markup=ProductMenu.get_main_menu())
+        previous = self.last_prices.get(key)
+        self.last_prices[key] = prices
+        if previous is None:
             return
+        if prices != previous:
+            self.changes += 1
+            self._set(key, self.interval(key) / 2)
+        else:
+            self._set(key, self.interval(key) * 1.25)
+
+    def next_interval(self, key: str) -> float:
+        """Интервал с учетом бюджета загрузок"""
+        stretch = max(1.0, self.demand / FETCH_BUDGET_PER_HOUR, len(self.fetches) / FETCH_BUDGET_PER_HOUR)
+        return self.interval(key) * stretch
+
+    def forget(self, key: str):
+        if key in self.intervals:
+            self.demand -= 3600 / self.intervals.pop(key)
+        self.last_prices.pop(key, None)
+
+    def stats(self) -> str:
+        return (
+            f"товаров {len(self.intervals)}, план {self.demand:.0f}/ч (бюджет {FETCH_BUDGET_PER_HOUR}), "
+            f"за час {len(self.fetches)}, изменений {self.changes}"
+        )
 
-        try:
-            loading_msg = await message.answer("⏳ <i>Проверяю ссылку…</i>", parse_mode="HTML")
-            temp_messages.append(loading_msg.message_id)
-
-            products_data = await batch_fetch_products([url])
-            name, prices, full_sku, is_out_of_stock = products_data.get(url, (None, {}, None, True))
-
-            # Проверка артикула
-            if not full_sku:
-                await loading_msg.edit_text("❌ Не удалось получить артикул!")
-                await delete_messages(chat_id, temp_messages)
-                return
-
-            # Проверка дубликатов
-            dupe_reason = is_duplicate(url, full_sku, user_info)
-            if dupe_reason:
-                await loading_msg.edit_text(dupe_reason)
-                temp_messages.append(loading_msg.message_id)
-                await delete_messages(chat_id, temp_messages)
-                return
-
-            # Наличие товара
-            if is_out_of_stock:
-                await loading_msg.edit_text("🚫 Товар закончился!")
-                temp_messages.append(loading_msg.message_id)
-                await delete_messages(chat_id, temp_messages)
-                return
-
-            if not name or not prices:
-                await loading_msg.edit_text("⚠️ Ошибка данных!")
-                temp_messages.append(loading_msg.message_id)
-                await delete_messages(chat_id, temp_messages)
-                return
-
-            # Успешное добавление
-            user_info.setdefault('urls', []).append(url)
-            user_info.setdefault('product_names', {})[url] = name
-            user_info.setdefault('previous_prices', {})[url] = prices
-            user_info.setdefault('skus', {})[full_sku] = url
-            user_info['last_active'] = datetime.now().isoformat()
-            save_user_data()
+adaptive_poller = AdaptivePoller()
 
-            success_text = (
-                f"✅ <b>Товар добавлен!</b>\n"
-                f"🏷 {name}\n"
-                f"📦 Артикул: <code>{full_sku}</code>\n"
-                f"💵 {get_price_display(prices)}₽\n"
-                f"🔗 <a href='{url}'>Ссылка на товар</a>\n"
-                f"⏱️ Режим проверки: {format_interval(user_info.get('interval', DEFAULT_INTERVAL))}"
-            )
-            await message.answer(success_text, parse_mode="HTML", disable_web_page_preview=True,
-                                reply_markup=ProductMenu.get_main_menu())
-            await delete_messages(chat_id, temp_messages)
-        except Exception as e:
-            await message.answer(f"⚠️ Произошла ошибка: {e}",
-                                 reply_markup=ProductMenu.get_main_menu())
-    else:
-        # Если ссылки Ozоn нет — просто удаляем сообщение без лишнего шума
-        try:
-            await bot.delete_message(message.chat.id, message.message_id)
-        except Exception:
-            pass
+def next_check_time(user_info: dict, now: float) -> float:
+    """Срок следующей проверки: слот интервала от прошлой проверки, без накопления дрейфа"""
+    last_check = user_info.get('last_check')
+    if not last_check:
+        # первая проверка — сейчас
+        return now
+    step = user_info.get('interval', DEFAULT_INTERVAL) * 3600
+    due = datetime.fromisoformat(last_check).timestamp() + step
+    if due < now:
+        # если бот был выключен — пропускаем "прошедшие" интервалы, проверяем по последнему
+        due += (now - due) // step * step
+    return due
+
+def schedule_product(key: str):
+    """Ставит товар режима "По изменению цены" в расписание, если он еще не там"""
+    if key in product_scheduler.due_at or key in adaptive_poller.in_flight:
+        return
+    entry = product_catalog.get(key) or {}
+    if entry.get('prices'):
+        # Изменение сравнивается с последней известной ценой, в том числе до перезапуска
+        adaptive_poller.last_prices.setdefault(key, entry['prices'])
+    fetched_at = datetime.fromisoformat(entry['fetched_at']).timestamp() if entry.get('fetched_at') else 0
+    product_scheduler.schedule(key, max(time.time(), fetched_at + adaptive_poller.next_interval(key)))
+
+async def seed_and_schedule(keys: List[str]):
+    await adaptive_poller.seed(keys)
+    for key in keys:
+        schedule_product(key)
+
+def schedule_user(chat_id: str):
+    user_info = user_data.get(chat_id)
+    if not user_info or not user_info.get('is_tracking', True):
+        due_scheduler.cancel(chat_id)
+        return
+    if user_info.get('interval', DEFAULT_INTERVAL) == 0:
+        # У товаров этого режима свое расписание
+        due_scheduler.cancel(chat_id)
+        keys = {product_key(url, user_info) for url in user_info['subscriptions']}
+        unseen = [key for key in keys if key not in adaptive_poller.intervals]
+        for key in keys.difference(unseen):
+            schedule_product(key)
+        if unseen:
+            # Новые для режима товары встают в расписание после чтения их истории
+            task = asyncio.create_task(seed_and_schedule(unseen))
+            adaptive_poller.seeding.add(task)
+            task.add_done_callback(adaptive_poller.seeding.discard)
+        return
+    due_scheduler.schedule(chat_id, next_check_time(user_info, time.time()))
+
+def schedule_all_users():
+    for interval in user_data.intervals():
+        for chat_id in user_data.with_interval(interval):
+            schedule_user(chat_id)
+    logger.info(
+        f"Планировщик проверок: {len(due_scheduler.due_at)} пользователей, "
+        f"{len(product_scheduler.due_at)} товаров по изменению цены"
+    )
 
-# =============================================
-# ПЛАНИРОВЩИК И ЗАПУСК
-# =============================================
+async def finish_due_check(chat_id: str, slot: float,
+                           products_data: Dict[str, Tuple[Optional[str], Dict[int, int], Optional[str], bool]]):
+    try:
+        await check_prices(chat_id, products_data=products_data)
+    finally:
+        # Отметка ставится и для прерванной проверки — иначе срок остался бы в прошлом
+        user_info = user_data.get(chat_id)
+        if user_info:
+            # ставим сам слот (а не now! — чтобы не было дрифта)
+            mutate("checked", chat_id, last_check=datetime.fromtimestamp(slot).isoformat())
+            if chat_id not in due_scheduler.due_at:
+                schedule_user(chat_id)
 
-async def dynamic_interval_check():
-    logger.info("=== Динамическая (по изменению цены) проверка цен ===")
-    now = datetime.now()
-    for chat_id, user_info in user_data.items():
-        if not user_info.get('is_tracking', True):
+async def run_due_checks(batch: List[Tuple[str, float]]):
+    """
+    Загружает товары пользователей, чей срок наступил (каждый товар один раз на всех),
+    и отдает проверку пользователя в пул, как только готовы его товары.
+    Загрузка ограничена CHECK_FETCH_TIMEOUT; кто не дождался своих товаров, проверяется повторно позже.
+    """
+    logger.info(f"=== Плановая проверка цен: {len(batch)} польз. ===")
+    slots = dict(batch)
+    submitted = set()
+    try:
+        async with asyncio.timeout(CHECK_FETCH_TIMEOUT):
+            async for chat_id, products_data in stream_for_users(list(slots)):
+                check_pool.submit(
+                    chat_id,
+                    lambda chat_id=chat_id, products_data=products_data: finish_due_check(chat_id, slots[chat_id], products_data)
+                )
+                submitted.add(chat_id)
+    except TimeoutError:
+        logger.warning(f"Загрузка товаров не уложилась в {CHECK_FETCH_TIMEOUT} с: "
+                       f"{len(slots) - len(submitted)} польз. перенесено")
+    finally:
+        # Без отметки о проверке срок остался бы в прошлом — возвращаем в расписание с паузой
+        for chat_id in slots.keys() - submitted:
+            schedule_user(chat_id)
+            due_scheduler.postpone(chat_id, CHECK_RETRY_DELAY)
+
+def adaptive_watchers(key: str) -> List[Tuple[str, str]]:
+    """Подписчики товара в режиме "По изменению цены": (chat_id, url подписки)"""
+    watchers = []
+    for chat_id in user_data.subscribers(key):
+        user_info = user_data[chat_id]
+        if user_info.get('interval') != 0 or not user_info.get('is_tracking', True):
             continue
-        if user_info.get('interval') != 0:
+        for url in user_info['subscriptions']:
+            if product_key(url, user_info) == key:
+                watchers.append((chat_id, url))
+    return watchers
+
+async def finish_product_check(chat_id: str,
+                               products_data: Dict[str, Tuple[Optional[str], Dict[int, int], Optional[str], bool]]):
+    await check_prices(chat_id, products_data=products_data)
+    if chat_id in user_data:
+        mutate("checked", chat_id, last_check=datetime.now().isoformat())
+
+async def run_product_checks(batch: List[Tuple[str, float]]):
+    """
+    Товары режима "По изменению цены", чей срок наступил: загрузка, подстройка частоты
+    и проверка у подписчиков — одна на пользователя, когда готовы все его товары из пачки.
+    Товар без таких подписчиков выпадает из расписания.
+    """
+    plan: Dict[str, List[str]] = {}  # url -> ключи товара (артикул и ссылка могут вести на одну страницу)
+    watchers: Dict[str, List[Tuple[str, str]]] = {}
+    waiting: Dict[str, set] = {}  # chat_id -> ключи, которых он ждет
+    results: Dict[str, dict] = {}
+    for key, _ in batch:
+        watchers[key] = adaptive_watchers(key)
+        if not watchers[key]:
+            adaptive_poller.forget(key)
             continue
+        plan.setdefault(watchers[key][0][1], []).append(key)
+        adaptive_poller.in_flight.add(key)
+        for chat_id, _ in watchers[key]:
+            waiting.setdefault(chat_id, set()).add(key)
+            results.setdefault(chat_id, {})
 
-        last_check_str = user_info.get('last_check')
-        last_check = datetime.fromisoformat(last_check_str) if last_check_str else None
-
-        # Проверяем не чаще раза в 50 минут
-        if not last_check or (now - last_check) >= timedelta(minutes=25):
-            logger.info(f"[dynamic] Проверка {chat_id}, last_check='{last_check_str}'")
-            await check_prices(chat_id)
-            user_info['last_check'] = now.isoformat()
-            save_user_data()
+    try:
+        async for url, data in iter_fetch_products(list(plan)):
+            ready = set()
+            for key in plan[url]:
+                adaptive_poller.observe(key, data[1])
+                for chat_id, subscription_url in watchers[key]:
+                    results[chat_id][subscription_url] = data
+                    waiting[chat_id].discard(key)
+                    ready.add(chat_id)
+            for chat_id in ready:
+                if waiting[chat_id]:
+                    continue
+                del waiting[chat_id]
+                check_pool.submit(
+                    chat_id,
+                    lambda chat_id=chat_id, products_data=results.pop(chat_id): finish_product_check(chat_id, products_data)
+                )
+    finally:
+        now = time.time()
+        for key, key_watchers in watchers.items():
+            adaptive_poller.in_flight.discard(key)
+            if key_watchers:
+                product_scheduler.schedule(key, now + adaptive_poller.next_interval(key))
+
+def reschedule_user(chat_id: str):
+    # Проверка в пуле сама поставит следующий срок
+    if not check_pool.busy(chat_id):
+        schedule_user(chat_id)
+
+def reschedule_product(key: str):
+    if adaptive_watchers(key):
+        schedule_product(key)
+    else:
+        adaptive_poller.forget(key)
 
+due_scheduler = DueScheduler(run_due_checks, reschedule_user)
+product_scheduler = DueScheduler(run_product_checks, reschedule_product)
 
-async def scheduled_price_check():
-    logger.info("=== Стандартная проверка цен ===")
-    now = datetime.now()
-    for chat_id, user_info in user_data.items():
-        if not user_info.get('is_tracking', True):
-            continue
-
-        interval = user_info.get('interval', DEFAULT_INTERVAL)
-        if interval == 0:
+async def migrate_short_links():
+    """Фоново заменяет сохраненные короткие ссылки на канонические ссылки товаров"""
+    migrated = 0
+    for chat_id in list(user_data):
+        user_info = user_data.get(chat_id)
+        if not user_info:
             continue
+        for url in [u for u in user_info.get('subscriptions', {}) if is_short_link(u)]:
+            canonical = await resolve_short_link(url)
+            await asyncio.sleep(0.5)
+            if canonical == url or url not in user_info.get('subscriptions', {}):
+                continue
+            mutate("replace_url", chat_id, old_url=url, new_url=canonical)
+            migrated += 1
 
-        last_check_str = user_info.get('last_check')
-        last_check = datetime.fromisoformat(last_check_str) if last_check_str else None
-
-        # Вычисляем следующий ОЖИДАЕМЫЙ чекпоинт
-        if not last_check:
-            # первая проверка — ставим сейчас
-            next_check = now
-        else:
-            next_check = last_check + timedelta(hours=interval)
-            # если бот был выключен — пропускаем "прошедшие" интервалы
-            while next_check + timedelta(hours=interval) <= now:
-                next_check += timedelta(hours=interval)
-
-        if not last_check or now >= next_check:
-            logger.info(f"[scheduled] Проверка {chat_id}, last_check='{last_check_str}', interval={interval}")
-            await check_prices(chat_id)
-            # ставим следующий чекпоинт (а не now! — чтобы не было дрифта)
-            user_info['last_check'] = next_check.isoformat()
-            save_user_data()
-
+    if migrated:
+        logger.info(f"Короткие ссылки: заменено {migrated}")
 
+async def compact_price_history():
+    await asyncio.to_thread(price_history.compact)
+    logger.info("История цен сжата")
 
 async def cleanup_inactive_users():
     threshold = datetime.now() - timedelta(days=INACTIVE_USER_THRESHOLD_DAYS)
-    inactive_users = [
-        chat_id for chat_id, user_info in user_data.items()
-        if datetime.fromisoformat(user_info['last_active']) < threshold
-    ]
+    inactive_users = user_data.inactive_since(threshold)
 
     for chat_id in inactive_users:
-        del user_data[chat_id]
+        mutate("delete_user", chat_id)
 
     if inactive_users:
         logger.info(f"Удалено {len(inactive_users)} неактивных пользователей")
-        save_user_data()
+
+    # Товары без подписчиков убираем из каталога
+    orphaned = [key for key in product_catalog if not user_data.subscribers(key)]
+    for key in orphaned:
+        mutate_product("product_drop", key)
+    if orphaned:
+        logger.info(f"Из каталога удалено {len(orphaned)} товаров без подписчиков")
 
 async def main():
     scheduler = AsyncIOScheduler()
-    scheduler.add_job(scheduled_price_check, 'interval', minutes=10, jitter=30)
-
+    scheduler.add_job(cleanup_inactive_users, 'cron', hour=3)
+    scheduler.add_job(compact_price_history, 'cron', hour=4)
+    # Ссылки, не раскрытые с первого раза, подхватываются из кэша после плановых проверок
     scheduler.add_job(
-        dynamic_interval_check,
+        migrate_short_links,
         'interval',
-        minutes=30,
-        jitter=300
+        hours=6,
+        next_run_time=datetime.now() + timedelta(minutes=1)
     )
 
-    scheduler.add_job(cleanup_inactive_users, 'cron', hour=3)
-    scheduler.add_job(update_skus, 'interval', hours=24)
-
-    scheduler.start()
+    if FETCH_ENGINE not in FETCH_ENGINES:
+        raise ValueError(f"Неизвестный FETCH_ENGINE: {FETCH_ENGINE}")
+    if SCRAPE_PROFILE not in SCRAPE_PROFILES:
+        raise ValueError(f"Неизвестный SCRAPE_PROFILE: {SCRAPE_PROFILE} (доступны: {', '.join(SCRAPE_PROFILES)})")
+
+    async def start_scheduler():
+        # Плановые задачи обходят всех пользователей — запускаем их после миграции схемы
+        await run_migrations()
+        scheduler.start()
+        await adaptive_poller.seed({
+            product_key(url, user_data[chat_id])
+            for chat_id in user_data.with_interval(0) for url in user_data[chat_id]['subscriptions']
+        })
+        schedule_all_users()
+        await asyncio.gather(due_scheduler.run(), product_scheduler.run())
+
+    asyncio.create_task(start_scheduler())
+    check_pool.start()
+    if FETCH_ENGINE == "selenium":
+        asyncio.create_task(asyncio.to_thread(driver_pool.warm_up))
+    asyncio.create_task(store_flusher.run())
+    asyncio.create_task(price_history.run())
 
     dp = Dispatcher()
     dp.include_router(router)
@@ -1252,8 +3538,19 @@ async def main():
     try:
         await dp.start_polling(bot)
     finally:
-        scheduler.shutdown()
+        if scheduler.running:
+            scheduler.shutdown()
+        check_pool.stop()
+        await outbox.close()
+        selenium_executor.shutdown(wait=False, cancel_futures=True)
+        await asyncio.to_thread(driver_pool.close)
+        await close_http_session()
+        await playwright_browser.close()
         save_user_data()
+        await store_flusher.flush()
+        await short_links.flush()
+        await price_history.flush()
+        storage.close()
 
 if __name__ == "__main__":
     try:
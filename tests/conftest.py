@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# bot.py читает настройки из окружения и создает файлы данных в текущей папке при импорте
+os.environ.setdefault("OWNER_ID", "1")
+os.environ.setdefault("BOT_TOKEN", "1:test")
+os.chdir(tempfile.mkdtemp(prefix="ozon_tracker_tests_"))
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
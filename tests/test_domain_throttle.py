@@ -0,0 +1,107 @@
+"""Ограничитель загрузок домена: AIMD-скорость и предохранитель с пробными запросами"""
+import asyncio
+import time
+
+import pytest
+
+import bot
+
+def tripped(domain: str = "ozon.test") -> bot.DomainThrottle:
+    throttle = bot.DomainThrottle(domain)
+    for _ in range(bot.BREAKER_MIN_SAMPLES):
+        throttle.record("captcha")
+    return throttle
+
+def cooled_down(throttle: bot.DomainThrottle) -> bot.DomainThrottle:
+    throttle.open_until = time.monotonic() - 1
+    throttle.tokens = 1.0
+    return throttle
+
+def test_rate_grows_additively_and_drops_multiplicatively():
+    throttle = bot.DomainThrottle("ozon.test")
+    throttle.record("ok")
+    assert throttle.rate == pytest.approx(bot.THROTTLE_START_RATE + bot.THROTTLE_RATE_STEP)
+    rate = throttle.rate
+    throttle.record("error")
+    assert throttle.rate == pytest.approx(rate * 0.8)
+    rate = throttle.rate
+    throttle.record("captcha")
+    assert throttle.rate == pytest.approx(rate * 0.5)
+    for _ in range(50):
+        throttle.record("captcha")
+    assert throttle.rate == bot.THROTTLE_MIN_RATE
+    throttle.rate = bot.THROTTLE_MAX_RATE
+    throttle.record("ok")
+    assert throttle.rate == bot.THROTTLE_MAX_RATE
+
+def test_breaker_trips_on_failure_ratio_and_rejects_long_waits():
+    throttle = bot.DomainThrottle("ozon.test")
+    for outcome in ["ok", "ok", "ok", "error"]:
+        throttle.record(outcome)
+    assert throttle.state == "closed"
+    for _ in range(3):
+        throttle.record("captcha")
+    assert throttle.state == "open"
+    assert bot.BREAKER_COOLDOWN > bot.BREAKER_MAX_WAIT
+    with pytest.raises(bot.CircuitOpen):
+        asyncio.run(throttle.acquire())
+
+def test_half_open_lets_a_single_probe_through():
+    async def scenario():
+        throttle = cooled_down(tripped())
+        probe = await throttle.acquire()
+        throttle.tokens = 1.0
+        # Пока проба не завершилась, остальные ждут, даже со свободным токеном
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(throttle.acquire(), 0.2)
+        return throttle, probe
+    throttle, probe = asyncio.run(scenario())
+    assert probe is True
+    assert throttle.state == "half_open" and throttle.probing
+
+def test_successful_probe_closes_the_breaker():
+    async def scenario():
+        throttle = cooled_down(tripped())
+        throttle.cooldown = bot.BREAKER_COOLDOWN * 4
+        await throttle.acquire()
+        throttle.record("ok")
+        throttle.tokens = 1.0
+        return throttle, await throttle.acquire()
+    throttle, probe = asyncio.run(scenario())
+    assert throttle.state == "closed" and not throttle.probing
+    assert throttle.cooldown == bot.BREAKER_COOLDOWN
+    assert probe is False
+
+def test_failed_probe_reopens_with_doubled_cooldown():
+    async def scenario():
+        throttle = cooled_down(tripped())
+        await throttle.acquire()
+        throttle.record("captcha")
+        return throttle
+    throttle = asyncio.run(scenario())
+    assert throttle.state == "open" and not throttle.probing
+    assert throttle.cooldown == min(bot.BREAKER_COOLDOWN * 2, bot.BREAKER_MAX_COOLDOWN)
+    assert throttle.open_until > time.monotonic() + bot.BREAKER_COOLDOWN
+
+def test_cancelled_probe_does_not_block_the_domain(monkeypatch):
+    domain = "probe.test"
+
+    async def scenario():
+        started = asyncio.Event()
+
+        async def hanging_engine(url):
+            started.set()
+            await asyncio.sleep(3600)
+        monkeypatch.setitem(bot.FETCH_ENGINES, bot.FETCH_ENGINE, hanging_engine)
+        monkeypatch.setitem(bot.domain_slots, domain, asyncio.Semaphore(1))
+        monkeypatch.setitem(bot.domain_throttles, domain, cooled_down(tripped(domain)))
+        fetch = asyncio.create_task(bot.fetch_limited(f"https://{domain}/product/x-1/"))
+        await started.wait()
+        assert bot.domain_throttles[domain].probing
+        fetch.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await fetch
+        # Следующий запрос снова может стать пробой, а не ждет конца пробы вечно
+        bot.domain_throttles[domain].tokens = 1.0
+        return await asyncio.wait_for(bot.domain_throttles[domain].acquire(), 1)
+    assert asyncio.run(scenario()) is True
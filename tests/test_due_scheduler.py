@@ -0,0 +1,88 @@
+"""Очередь проверок по сроку: выдача пачек и возврат в расписание после сбоя"""
+import asyncio
+import time
+
+import pytest
+
+import bot
+
+def make_scheduler(run_batch, rearm=None):
+    """Планировщик, чей reschedule ставит срок на час вперед (или в rearm[chat_id]) и запоминает вызовы"""
+    calls = []
+    rearm = rearm or {}
+
+    def reschedule(chat_id):
+        calls.append(chat_id)
+        scheduler.schedule(chat_id, rearm.get(chat_id, time.time() + 3600))
+    scheduler = bot.DueScheduler(run_batch, reschedule)
+    return scheduler, calls
+
+def test_pop_due_takes_only_current_entries():
+    scheduler, _ = make_scheduler(None)
+    now = time.time()
+    scheduler.schedule("a", now - 10)
+    scheduler.schedule("b", now + 100)
+    scheduler.schedule("c", now - 5)
+    scheduler.schedule("c", now + 50)  # перенос: старая запись кучи устарела
+    scheduler.schedule("d", now - 1)
+    scheduler.cancel("d")
+    assert [chat_id for chat_id, _ in scheduler._pop_due(now)] == ["a"]
+    assert set(scheduler.due_at) == {"b", "c"}
+
+def test_run_dispatches_due_batch():
+    batches = []
+
+    async def run_batch(batch):
+        batches.append(sorted(chat_id for chat_id, _ in batch))
+
+    async def scenario():
+        scheduler, _ = make_scheduler(run_batch)
+        scheduler.schedule("a", time.time())
+        scheduler.schedule("b", time.time() - 1)
+        scheduler.schedule("later", time.time() + 3600)
+        runner = asyncio.create_task(scheduler.run())
+        await asyncio.sleep(0.05)
+        runner.cancel()
+        return scheduler
+    scheduler = asyncio.run(scenario())
+    assert batches == [["a", "b"]]
+    assert scheduler.dispatched == 2
+    assert set(scheduler.due_at) == {"a", "b", "later"}  # a и b вернул reschedule
+
+@pytest.mark.parametrize("failure", [RuntimeError("boom"), asyncio.CancelledError()])
+def test_failed_batch_is_rescheduled_after_retry_delay(failure):
+    async def run_batch(batch):
+        raise failure
+
+    async def scenario():
+        # reschedule вернул бы уже наступивший срок — повтор не раньше CHECK_RETRY_DELAY
+        scheduler, calls = make_scheduler(run_batch, rearm={"a": 0, "b": 0})
+        now = time.time()
+        scheduler.schedule("a", now - 1)
+        scheduler.schedule("b", now - 1)
+        batch = scheduler._pop_due(now)
+        assert scheduler.due_at == {}
+        try:
+            await scheduler._dispatch(batch)
+        except asyncio.CancelledError:
+            pass
+        return scheduler, calls, now
+    scheduler, calls, now = asyncio.run(scenario())
+    assert sorted(calls) == ["a", "b"]
+    for when in scheduler.due_at.values():
+        assert when >= now + bot.CHECK_RETRY_DELAY
+
+def test_entries_rearmed_by_the_batch_are_left_alone():
+    async def run_batch(batch):
+        scheduler.schedule("a", time.time() + 7200)
+        raise RuntimeError("после a")
+
+    async def scenario():
+        now = time.time()
+        scheduler.schedule("a", now - 1)
+        scheduler.schedule("b", now - 1)
+        await scheduler._dispatch(scheduler._pop_due(now))
+    scheduler, calls = make_scheduler(run_batch)
+    asyncio.run(scenario())
+    assert calls == ["b"]
+    assert scheduler.due_at["a"] > time.time() + 3600
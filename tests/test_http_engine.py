@@ -0,0 +1,123 @@
+"""HTTP-движок загрузки товаров против локального сервера с сохраненными страницами"""
+import asyncio
+import json
+from pathlib import Path
+
+import pytest
+from aiohttp import test_utils, web
+
+import bot
+
+PAGES = Path(__file__).parent / "pages"
+HITS = web.AppKey("hits", list)
+
+# Путь товара -> (ответ page-composer, ответ страницы): имя файла из pages/ или HTTP-статус
+ROUTES = {
+    "/product/test-phone-1234567890/": ("composer.json", 404),
+    "/product/test-buds-987654321/": (404, "product_states.html"),
+    "/product/test-kettle-555666777/": (404, "product_markup.html"),
+    "/product/test-beans-111222333/": (404, "out_of_stock.html"),
+    "/product/blocked-1/": (403, 403),
+    "/product/captcha-1/": (404, "captcha.html"),
+    "/product/broken-1/": (404, "broken.html"),
+}
+
+def respond(source, content_type: str) -> web.Response:
+    if isinstance(source, int):
+        return web.Response(status=source)
+    return web.Response(text=(PAGES / source).read_text(encoding="utf-8"), content_type=content_type)
+
+async def composer(request: web.Request) -> web.Response:
+    request.app[HITS].append(("composer", request.query.get("url")))
+    source, _ = ROUTES.get(request.query.get("url"), (404, 404))
+    return respond(source, "application/json")
+
+async def page(request: web.Request) -> web.Response:
+    request.app[HITS].append(("page", request.path))
+    _, source = ROUTES.get(request.path, (404, 404))
+    return respond(source, "text/html")
+
+def run_with_server(scenario):
+    """Запускает сценарий scenario(base_url, hits) рядом с локальным сервером страниц"""
+    async def main():
+        app = web.Application()
+        app[HITS] = []
+        app.router.add_get(bot.COMPOSER_API_PATH, composer)
+        app.router.add_get("/product/{slug}/", page)
+        server = test_utils.TestServer(app, host="127.0.0.1")
+        await server.start_server()
+        try:
+            return await scenario(str(server.make_url("")).rstrip("/"), app[HITS])
+        finally:
+            await bot.close_http_session()
+            await server.close()
+    return asyncio.run(main())
+
+def test_parse_widget_states_from_composer_json():
+    states = json.loads((PAGES / "composer.json").read_text(encoding="utf-8"))["widgetStates"]
+    assert bot.parse_widget_states(states) == (
+        "Смартфон Test Phone 8/256 ГБ, черный", {1: 24990, 2: 27490}, "1234567890", False
+    )
+
+@pytest.mark.parametrize("name, expected", [
+    ("product_states.html", ("Наушники Test Buds Pro", {1: 3490, 2: 3990}, "987654321", False)),
+    ("product_markup.html", ("Чайник электрический Test Kettle 1.7 л", {1: 1290, 2: 1450}, "555666777", False)),
+    ("out_of_stock.html", ("Кофе в зернах Test Beans 1 кг", {}, "111222333", True)),
+    ("broken.html", (None, {}, None, False)),
+])
+def test_parse_product_html(name, expected):
+    assert bot.parse_product_html((PAGES / name).read_text(encoding="utf-8")) == expected
+
+def test_fetch_prefers_composer_json():
+    async def scenario(base, hits):
+        data = await bot.fetch_product_http(f"{base}/product/test-phone-1234567890/")
+        return data, hits
+    data, hits = run_with_server(scenario)
+    assert data == ("Смартфон Test Phone 8/256 ГБ, черный", {1: 24990, 2: 27490}, "1234567890", False)
+    assert [kind for kind, _ in hits] == ["composer"]
+
+@pytest.mark.parametrize("path, expected", [
+    ("/product/test-buds-987654321/", ("Наушники Test Buds Pro", {1: 3490, 2: 3990}, "987654321", False)),
+    ("/product/test-beans-111222333/", ("Кофе в зернах Test Beans 1 кг", {}, "111222333", True)),
+])
+def test_fetch_falls_back_to_page_html(path, expected):
+    async def scenario(base, hits):
+        return await bot.fetch_product_http(base + path), hits
+    data, hits = run_with_server(scenario)
+    assert data == expected
+    assert [kind for kind, _ in hits] == ["composer", "page"]
+
+@pytest.mark.parametrize("path", ["/product/blocked-1/", "/product/captcha-1/"])
+def test_fetch_raises_on_captcha(path):
+    async def scenario(base, hits):
+        return await bot.fetch_product_http(base + path)
+    with pytest.raises(bot.CaptchaDetected):
+        run_with_server(scenario)
+
+def test_fetch_returns_none_when_page_cannot_be_parsed():
+    async def scenario(base, hits):
+        return await bot.fetch_product_http(f"{base}/product/broken-1/")
+    assert run_with_server(scenario) is None
+
+def test_selenium_fallback_only_on_parse_failure(monkeypatch):
+    browser_calls = []
+
+    async def fake_selenium(url):
+        browser_calls.append(url)
+        return "Из браузера", {1: 100}, "42", False
+    monkeypatch.setattr(bot, "fetch_one_selenium", fake_selenium)
+
+    async def scenario(base, hits):
+        parsed = await bot.fetch_one_http(f"{base}/product/test-buds-987654321/")
+        broken = await bot.fetch_one_http(f"{base}/product/broken-1/")
+        try:
+            await bot.fetch_one_http(f"{base}/product/blocked-1/")
+        except bot.CaptchaDetected:
+            blocked = "captcha"
+        return parsed, broken, blocked, base
+
+    parsed, broken, blocked, base = run_with_server(scenario)
+    assert parsed[0] == "Наушники Test Buds Pro"
+    assert broken == ("Из браузера", {1: 100}, "42", False)
+    assert blocked == "captcha"
+    assert browser_calls == [f"{base}/product/broken-1/"]
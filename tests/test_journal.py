@@ -0,0 +1,102 @@
+"""Журнал изменений: проигрывание после снимка, ротация и восстановление после сбоя"""
+import json
+
+import bot
+
+URL = "https://ozon.ru/product/test-phone-1234567890/"
+
+def new_user() -> dict:
+    return {
+        'subscriptions': {},
+        'schema': bot.SCHEMA_VERSION,
+        'last_active': "2026-10-01T00:00:00",
+        'interval': 1,
+        'last_check': None,
+        'is_tracking': True,
+    }
+
+def open_storage(path):
+    """Как при запуске: снимок, затем хвост журнала"""
+    storage = bot.JournalStorage(path)
+    data, catalog = storage.load()
+    storage.replay(data, catalog)
+    return storage, data, catalog
+
+def commit(storage, data, catalog, record):
+    """Как commit_mutation: изменение применяется в памяти и журналируется"""
+    bot.apply_mutation(data, catalog, record)
+    storage.record(record)
+
+def test_replay_restores_mutations_without_snapshot(tmp_path):
+    path = tmp_path / "user_data.json"
+    storage, data, catalog = open_storage(path)
+    commit(storage, data, catalog, {"op": "create_user", "chat_id": "7", "user": new_user()})
+    commit(storage, data, catalog, {"op": "add_url", "chat_id": "7", "url": URL, "sku": "1234567890",
+                                    "prices": {1: 100}, "at": "2026-10-02T00:00:00"})
+    commit(storage, data, catalog, {"op": "price_update", "chat_id": "7", "url": URL, "prices": {1: 90, 2: 95}})
+    storage.close()
+    assert storage.groups >= 1
+
+    reopened, replayed, _ = open_storage(path)
+    reopened.close()
+    assert replayed == data
+    assert replayed["7"]['subscriptions'][URL] == {'sku': "1234567890", 'seen': {1: 90, 2: 95}}
+    assert reopened.seq == 3
+
+def test_torn_tail_is_dropped_and_journal_stays_appendable(tmp_path):
+    path = tmp_path / "user_data.json"
+    storage, data, catalog = open_storage(path)
+    commit(storage, data, catalog, {"op": "create_user", "chat_id": "7", "user": new_user()})
+    storage.close()
+    journal = path.with_suffix(".journal")
+    intact = journal.stat().st_size
+    with open(journal, "a", encoding="utf-8") as f:
+        f.write('{"seq": 2, "op": "set_interval", "chat_id": "7", "inter')
+
+    storage, data, catalog = open_storage(path)
+    assert journal.stat().st_size == intact
+    assert data["7"]['interval'] == 1
+    commit(storage, data, catalog, {"op": "set_interval", "chat_id": "7", "interval": 12,
+                                    "at": "2026-10-02T00:00:00"})
+    storage.close()
+
+    lines = journal.read_text(encoding="utf-8").splitlines()
+    assert [json.loads(line)["seq"] for line in lines] == [1, 2]
+    reopened, replayed, _ = open_storage(path)
+    reopened.close()
+    assert replayed["7"]['interval'] == 12
+
+def test_snapshot_rotates_journal_and_replay_applies_only_the_tail(tmp_path):
+    path = tmp_path / "user_data.json"
+    storage, data, catalog = open_storage(path)
+    commit(storage, data, catalog, {"op": "create_user", "chat_id": "7", "user": new_user()})
+    commit(storage, data, catalog, {"op": "set_interval", "chat_id": "7", "interval": 3, "at": "2026-10-02T00:00:00"})
+    storage.write(storage.prepare(data, catalog))
+    assert not path.with_suffix(".journal.1").exists()
+    commit(storage, data, catalog, {"op": "set_tracking", "chat_id": "7", "is_tracking": False,
+                                    "at": "2026-10-02T00:00:00"})
+    storage.close()
+
+    tail = path.with_suffix(".journal").read_text(encoding="utf-8").splitlines()
+    assert [json.loads(line)["op"] for line in tail] == ["set_tracking"]
+    reopened, replayed, _ = open_storage(path)
+    reopened.close()
+    assert replayed == data
+    assert reopened.seq == 3
+
+def test_rotated_journal_of_failed_snapshot_is_replayed_first(tmp_path):
+    path = tmp_path / "user_data.json"
+    storage, data, catalog = open_storage(path)
+    commit(storage, data, catalog, {"op": "create_user", "chat_id": "7", "user": new_user()})
+    # Снимок подготовлен (журнал ротирован), но не записан — например, бот упал
+    storage.prepare(data, catalog)
+    storage._rotation.wait()
+    commit(storage, data, catalog, {"op": "set_interval", "chat_id": "7", "interval": 6, "at": "2026-10-02T00:00:00"})
+    storage.close()
+    assert path.with_suffix(".journal.1").exists()
+    assert not path.exists()
+
+    reopened, replayed, _ = open_storage(path)
+    reopened.close()
+    assert replayed == data
+    assert replayed["7"]['interval'] == 6
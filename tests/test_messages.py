@@ -0,0 +1,22 @@
+"""Разбиение сводки на сообщения Telegram без порчи HTML-разметки"""
+import pytest
+
+import bot
+
+BLOCK = '🛍️ <b>Кофе &amp; чай</b>\n💳 <a href="https://ozon.ru/product/x-1/">1 290₽</a>\n📦 Артикул: 123'
+
+@pytest.mark.parametrize("limit", range(1, len(BLOCK) + 1))
+def test_truncate_html_keeps_markup_valid(limit):
+    text = bot.truncate_html(BLOCK, limit)
+    assert len(text) <= limit
+    assert text.count("<b>") == text.count("</b>")
+    assert text.count("<a ") == text.count("</a>")
+    assert not any(text.endswith(cut) for cut in ("&", "&a", "&am", "&amp"))
+
+def test_truncate_html_prefers_line_boundary():
+    assert bot.truncate_html(BLOCK, 60) == "🛍️ <b>Кофе &amp; чай</b>…"
+
+def test_split_message_truncates_oversized_block():
+    parts = bot.split_message(["<b>" + "слово " * 50 + "</b>", "конец"], limit=100)
+    assert [len(part) <= 100 for part in parts] == [True, True]
+    assert parts[0].endswith("…</b>") and parts[1] == "конец"